@@ -1,37 +1,6 @@
-import os
-import psycopg2
-from psycopg2.extras import DictCursor
-import reverse_geocoder
-import sys
-
-
-
-# Comment out line 12 when loading cloud db
-db = ''
-db = db + 'LOCAL_'
-
-# Set variables
-DB_NAME = os.environ[f'{db}DB_NAME']
-DB_USER = os.environ[f'{db}DB_USER']
-DB_HOST = os.environ[f'{db}DB_HOST']
-DB_PASSWORD = os.environ[f'{db}DB_PASSWORD']
-
-
-
-
-def db_connect():
-    connection_string = f'dbname={DB_NAME} user={DB_USER} host={DB_HOST} password={DB_PASSWORD}'
-
-    try:
-        connection = psycopg2.connect(connection_string)
-        connection.autocommit = True
-        print('Database connection successful')
-    
-    except:
-        sys.exit('Unable to connect to the database')
-
-    cursor = connection.cursor(cursor_factory=DictCursor)
-    return cursor
+from psycopg2.extras import execute_values
+import db
+from geocode_index import load_index, country_codes_for, memo_key, load_memo, save_memo
 
 
 
@@ -72,6 +41,12 @@ iso_dict = {
     # Antarctica
     'antarctica':['AQ']}
 
+# country code -> region, first region listed wins (same as scanning iso_dict in order)
+region_dict = {}
+for key, value in iso_dict.items():
+    for country_code in value:
+        region_dict.setdefault(country_code, key)
+
 
 
 
@@ -82,8 +57,9 @@ def get_stations():
             SELECT station_id, latitude, longitude FROM weather.weather_stations
             WHERE country_code IS NULL"""
     
-    cursor.execute(query)
-    results = cursor.fetchall()
+    with db.transaction() as cursor:
+        cursor.execute(query)
+        results = cursor.fetchall()
 
     print(f'Number of results: {len(results)}')
     return results
@@ -91,22 +67,43 @@ def get_stations():
 
 
 def update_cc_region_stations(stations):
+    if not stations:
+        print('Country codes and regions update complete')
+        return
+
+    # coordinates geocoded on an earlier run come from the memo, the rest in one bulk KD-tree query
+    memo = load_memo()
+    new_coords = list({memo_key(station[1], station[2]): (float(station[1]), float(station[2])) for station in stations\
+                       if memo_key(station[1], station[2]) not in memo}.items())
+
+    if new_coords:
+        country_codes = country_codes_for(load_index(), [coords for key, coords in new_coords])
+
+        for (key, coords), country_code in zip(new_coords, country_codes):
+            memo[key] = [country_code, region_dict.get(country_code)]
+        
+        save_memo(memo)
+
+    print(f'Geocoded {len(new_coords)} new coordinates for {len(stations)} stations')
     
-    for station in stations:
+    rows = []
+    unknown = set()
 
-        location = reverse_geocoder.search((station[1], station[2]))
-        country_code = location[0]['cc']
+    for station in stations:
+        country_code = memo[memo_key(station[1], station[2])][0]
+        region = region_dict.get(country_code)
 
-        for key, value in iso_dict.items():
-            if country_code in value:
-                region = key
-                break
-        else:
+        if region is None and country_code not in unknown:
             print(f'Could not determine region for {country_code}')
-            region = None
+            unknown.add(country_code)
+
+        rows.append((station[0], country_code, region))
 
-        insert_sql = "UPDATE weather.weather_stations SET country_code = %s, region = %s WHERE station_id = %s"
-        cursor.execute(insert_sql, (country_code, region, station[0]))
+    # set-based update joined to a VALUES list
+    update_sql = """UPDATE weather.weather_stations AS s SET country_code = v.country_code, region = v.region
+        FROM (VALUES %s) AS v(station_id, country_code, region) WHERE s.station_id = v.station_id"""
+    with db.transaction() as cursor:
+        execute_values(cursor, update_sql, rows, page_size=10000)
 
     print('Country codes and regions update complete')
     
@@ -118,11 +115,11 @@ def update_cc_region_stations(stations):
 
 if __name__ == "__main__":
     # Connect to database
-    cursor = db_connect()
+    db.get_pool()
 
     # get stations with coordinates
     stations = get_stations()
 
     update_cc_region_stations(stations)
 
-    cursor.close()
+    db.close_pool()
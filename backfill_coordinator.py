@@ -0,0 +1,209 @@
+import os
+import multiprocessing
+from datetime import date, datetime
+import db
+import populate_weather
+
+
+
+# shards the populate_weather backfill across worker processes, each bound to its own NOAA token
+# windows are leased from weather.work_queue with FOR UPDATE SKIP LOCKED, so workers can be added
+# or restarted at any time: an expired lease goes back to the pool and resumes at its committed page
+
+# NOAA_TOKENS is a comma separated list of tokens, falls back to the single NOAA_TOKEN
+NOAA_TOKENS = [token.strip() for token in os.environ.get('NOAA_TOKENS', os.environ['NOAA_TOKEN']).split(',') if token.strip()]
+
+# a lease covers the planned calls at the per second rate plus headroom, a crashed worker's window is picked up after it runs out
+LEASE_BASE_SECONDS = 300
+LEASE_SECONDS_PER_CALL = 5
+MAX_ATTEMPTS = 5
+
+
+
+
+WORK_TABLE_SQL = """CREATE TABLE IF NOT EXISTS weather.work_queue (
+    id bigserial,
+    url_pre text PRIMARY KEY,
+    next_offset integer NOT NULL DEFAULT 1,
+    planned_calls integer NOT NULL DEFAULT 1,
+    status text NOT NULL DEFAULT 'pending',
+    worker text,
+    lease_until timestamp,
+    attempts integer NOT NULL DEFAULT 0,
+    updated_at timestamp NOT NULL DEFAULT now());
+    CREATE INDEX IF NOT EXISTS work_queue_status_idx ON weather.work_queue (status, id)"""
+
+# re-planning keeps leased and done windows as they are and gives failed windows another round
+ENQUEUE_SQL = """INSERT INTO weather.work_queue (url_pre, next_offset, planned_calls) VALUES ($1,$2,$3)
+    ON CONFLICT (url_pre) DO UPDATE SET status = 'pending', attempts = 0, next_offset = EXCLUDED.next_offset,
+    planned_calls = EXCLUDED.planned_calls, updated_at = now()
+    WHERE weather.work_queue.status IN ('pending', 'failed')"""
+
+# next batch of pending windows (or ones whose lease ran out), each resumed at its furthest committed page
+# the batch is fetched concurrently, so its lease covers the planned calls of the whole batch
+LEASE_SQL = """WITH next AS (SELECT id, planned_calls FROM weather.work_queue
+          WHERE status = 'pending' OR (status = 'leased' AND lease_until < now())
+          ORDER BY id LIMIT $4 FOR UPDATE SKIP LOCKED),
+    batch AS (SELECT sum(planned_calls) AS calls FROM next)
+    UPDATE weather.work_queue AS w SET status = 'leased', worker = $1, attempts = w.attempts + 1, updated_at = now(),
+    lease_until = now() + make_interval(secs => $2 + $3 * batch.calls)
+    FROM next, batch
+    WHERE w.id = next.id
+    RETURNING w.url_pre, GREATEST(w.next_offset, coalesce((SELECT p.next_offset FROM weather.load_progress p WHERE p.request_key = w.url_pre), 1)),
+    coalesce((SELECT p.completed FROM weather.load_progress p WHERE p.request_key = w.url_pre), false), w.attempts"""
+
+# a window is done once its last page is committed, otherwise it goes back to the pool at the committed page
+FINISH_SQL = """UPDATE weather.work_queue AS w SET worker = NULL, lease_until = NULL, updated_at = now(),
+    next_offset = coalesce(p.next_offset, w.next_offset),
+    status = CASE WHEN coalesce(p.completed, false) THEN 'done' WHEN w.attempts >= $3 THEN 'failed' ELSE 'pending' END
+    FROM (SELECT $1::text AS url_pre) AS k LEFT JOIN weather.load_progress p ON p.request_key = k.url_pre
+    WHERE w.url_pre = k.url_pre AND w.worker = $2
+    RETURNING w.status"""
+
+
+
+
+def create_work_table(cursor):
+    cursor.execute(WORK_TABLE_SQL)
+    return
+
+
+
+def enqueue_work(windows):
+    # windows are (url_pre, offset, calls) tuples from plan_backfill
+    with db.transaction() as cursor:
+        create_work_table(cursor)
+        db.execute_prepared(cursor, 'enqueue_work', ENQUEUE_SQL, windows)
+        cursor.execute("SELECT status, count(*), coalesce(sum(planned_calls), 0) FROM weather.work_queue GROUP BY status ORDER BY status")
+        summary = cursor.fetchall()
+
+    for status, windows_count, calls in summary:
+        print(f'{status}: {windows_count} windows, {calls} planned calls')
+
+    return
+
+
+
+def lease_windows(worker, lease_size):
+    # [(url_pre, offset, completed, attempts)], empty when nothing is left to lease
+    with db.transaction() as cursor:
+        db.execute_prepared(cursor, 'lease_windows', LEASE_SQL, [(worker, LEASE_BASE_SECONDS, LEASE_SECONDS_PER_CALL, lease_size)])
+        return cursor.fetchall()
+
+
+
+def finish_window(worker, url_pre):
+    with db.transaction() as cursor:
+        db.execute_prepared(cursor, 'finish_window', FINISH_SQL, [(url_pre, worker, MAX_ATTEMPTS)])
+        row = cursor.fetchone()
+
+    # None: the lease expired and another worker took the window over
+    return row[0] if row else None
+
+
+
+
+def run_worker(token, worker, fetch_workers=4, lease_size=16):
+    # one process: leases lease_size windows at a time and keeps fetch_workers requests of the batch in flight
+    # until the queue is empty or this token's daily quota runs out
+    # DailyLimitExceeded exits through populate_weather.exit_script, the held leases simply expire
+    populate_weather.set_variables(token)
+    populate_weather.metrics_file = f'populate_weather_{worker}.prom'
+    db.get_pool()
+    loaded = 0
+
+    while True:
+        leases = lease_windows(worker, lease_size)
+
+        if not leases:
+            break
+
+        windows = [(url_pre, offset, 1) for url_pre, offset, completed, attempts in leases if not completed]
+
+        if fetch_workers > 1:
+            populate_weather.fetch_concurrent(windows, fetch_workers)
+        else:
+            populate_weather.api_call_generator(windows)
+
+        # rows and checkpoints have to be committed before the windows are released
+        populate_weather.flush_data()
+
+        for url_pre, offset, completed, attempts in leases:
+            status = finish_window(worker, url_pre)
+            if status == 'done':
+                loaded += 1
+
+            elif status == 'failed':
+                print(f'{worker}: giving up on {url_pre} after {attempts} attempts')
+
+    print(f'{worker}: queue empty, {loaded} windows loaded, {populate_weather.RATE_LIMITER.remaining()} calls left today')
+    populate_weather.report_metrics()
+    populate_weather.RATE_LIMITER.close()
+    db.close_pool()
+    return
+
+
+
+def start_workers(tokens, workers_per_token=1, fetch_workers=4, lease_size=16):
+    # spawn so every worker starts with its own pool, rate limiter and loader state
+    context = multiprocessing.get_context('spawn')
+    processes = []
+
+    for token_number, token in enumerate(tokens):
+        for worker_number in range(workers_per_token):
+            worker = f'{os.uname().nodename}-{os.getpid()}-t{token_number}-w{worker_number}'
+            process = context.Process(target=run_worker, args=(token, worker, fetch_workers, lease_size), name=worker)
+            process.start()
+            processes.append(process)
+
+    print(f'Started {len(processes)} workers on {len(tokens)} tokens')
+
+    for process in processes:
+        process.join()
+
+        if process.exitcode:
+            print(f'{process.name} exited with code {process.exitcode}')
+
+    return
+
+
+
+
+if __name__ == "__main__":
+    # Connect to database
+    db.get_pool()
+
+
+    '''
+    set variables
+    '''
+    populate_weather.set_variables(NOAA_TOKENS[0])
+
+    # processes per token, workers sharing a token share its rate budget through api_calls.sqlite
+    workers_per_token = 1
+
+    # requests kept in flight by each process and windows it leases at a time
+    fetch_workers = 4
+    lease_size = 16
+
+    # plan = False only starts workers on whatever is already queued (adding workers to a running backfill)
+    plan = True
+
+    min_date = datetime.strptime('1950-01-01', '%Y-%m-%d').date()
+    max_date = date.today()
+
+
+    if plan:
+        filtered_stations = populate_weather.filter_stations(create_station_html=False)
+        dense_plan, shared_windows = populate_weather.plan_backfill(filtered_stations, min_date, max_date)
+        enqueue_work([window for station in dense_plan for window in station[2]] + shared_windows)
+
+    populate_weather.RATE_LIMITER.close()
+    db.close_pool()
+
+    start_workers(NOAA_TOKENS, workers_per_token, fetch_workers, lease_size)
+
+    # workers only keep station rollups current, region rows are recomputed once they are done
+    db.get_pool()
+    populate_weather.roll_up_regions()
+    db.close_pool()
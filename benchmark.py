@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from datetime import date, datetime
+import requests
+from mock_cdo_server import serve, API_PATH
+
+
+
+# offline end-to-end benchmark: populate_stations + populate_weather against mock_cdo_server.py
+# and a throwaway Postgres database named by BENCHMARK_DB_NAME (its weather schema is dropped and recreated)
+# every run appends one json line to benchmark_results.jsonl so loader, rate limiter and clustering
+# changes can be compared on the same machine
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# tables the scripts expect to exist already
+BASE_TABLES_SQL = """DROP SCHEMA IF EXISTS weather CASCADE;
+    CREATE SCHEMA weather;
+
+    CREATE TABLE weather.weather_stations (
+    station_id text PRIMARY KEY,
+    name text,
+    latitude numeric,
+    longitude numeric,
+    elevation numeric,
+    elevation_unit text,
+    country_code text,
+    region text,
+    min_date date,
+    max_date date,
+    data_coverage numeric);
+
+    CREATE TABLE weather.weather_usa_97 (
+    station_id text NOT NULL,
+    date timestamp NOT NULL,
+    datatype text NOT NULL,
+    value numeric,
+    attributes text,
+    PRIMARY KEY (station_id, date, datatype))"""
+
+
+
+
+def start_server(port, stations, latency, jitter, error_rate):
+    # own process so its cpu and memory stay out of the measurements
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=(port, stations, latency, jitter, error_rate), daemon=True)
+    server.start()
+
+    for attempt in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}{API_PATH}/stats', timeout=1)
+            return server
+
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    server.terminate()
+    sys.exit('Mock CDO server did not start')
+
+
+
+def server_stats(port):
+    return requests.get(f'http://127.0.0.1:{port}{API_PATH}/stats', timeout=5).json()
+
+
+
+def run_benchmark(port=8765, stations=50, min_date='2020-01-01', workers=4, latency=0.05, jitter=0.02, error_rate=0.01,
+                  rate=1000.0, load_mode='copy', storage_mode='compact', resolution=None, label=''):
+    if 'BENCHMARK_DB_NAME' not in os.environ:
+        sys.exit('Set BENCHMARK_DB_NAME to a throwaway database, its weather schema is dropped')
+
+    server = start_server(port, stations, latency, jitter, error_rate)
+
+    # settings are read when the scripts are imported, so they are imported only after these are set
+    os.environ['NOAA_API_URL'] = f'http://127.0.0.1:{port}{API_PATH}'
+    os.environ['DB_TARGET'] = 'local'
+    os.environ['LOCAL_DB_NAME'] = os.environ['BENCHMARK_DB_NAME']
+    # required at import, the mock server ignores it
+    os.environ.setdefault('NOAA_TOKEN', 'benchmark')
+
+    import db
+    import populate_stations
+    import populate_weather
+    import compact_storage
+    import rollups
+    from rate_limiter import TokenBucket
+    from response_cache import ResponseCache
+
+    work_dir = tempfile.mkdtemp(prefix='noaa_benchmark_')
+    rate_limiter = None
+    timings = {}
+
+    try:
+        db.get_pool()
+        with db.transaction() as cursor:
+            cursor.execute(BASE_TABLES_SQL)
+
+        # the schema was just dropped, partitions and rollup tables remembered by an earlier run in this process are gone
+        compact_storage.PARTITIONS.clear()
+        rollups.READY = False
+
+        # fresh cache and rate limiter ledger in the work directory, nothing is served from a previous run
+        # and the real api_calls.sqlite / noaa_cache are never touched
+        response_cache = ResponseCache(os.path.join(work_dir, 'cache'))
+        rate_limiter = TokenBucket('benchmark', os.path.join(work_dir, 'api_calls.sqlite'), rate=rate, burst=max(1, int(rate)), daily_limit=10 ** 9)
+
+        populate_stations.RESPONSE_CACHE = response_cache
+        populate_stations.RATE_LIMITER = rate_limiter
+        populate_stations.retries = 4
+
+        started = time.perf_counter()
+        populate_stations.sync_weather_stations(workers)
+        timings['stations_seconds'] = time.perf_counter() - started
+
+        # geocoding is not part of the benchmark, the mock catalog is all US
+        with db.transaction() as cursor:
+            cursor.execute("UPDATE weather.weather_stations SET country_code = 'US', region = 'North America'")
+
+        populate_weather.set_variables('benchmark', rate_limiter, response_cache)
+        populate_weather.metrics_file = None
+        populate_weather.load_mode = load_mode
+        populate_weather.storage_mode = storage_mode
+
+        started = time.perf_counter()
+        filtered_stations = populate_weather.filter_stations(create_station_html=False, resolution=resolution)
+        timings['filter_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        populate_weather.populate_weather(filtered_stations, datetime.strptime(min_date, '%Y-%m-%d').date(), date.today(),
+                                          single_station_load=False, workers=workers)
+        populate_weather.flush_data()
+        populate_weather.roll_up_regions()
+        timings['weather_seconds'] = time.perf_counter() - started
+
+        with db.transaction() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {populate_weather.FACT_TABLES[storage_mode]}')
+            rows = cursor.fetchone()[0]
+
+        stats = server_stats(port)
+        result = {
+            'label': label,
+            'run_at': datetime.now().isoformat(timespec='seconds'),
+            'settings': {'stations': stations, 'min_date': min_date, 'workers': workers, 'latency': latency, 'error_rate': error_rate,
+                         'rate': rate, 'load_mode': load_mode, 'storage_mode': storage_mode, 'resolution': resolution},
+            'calls': stats['stations_requests'] + stats['data_requests'],
+            'errors': stats['errors'],
+            'rows_served': stats['rows'],
+            'rows_loaded': rows,
+            'stations_loaded': len(filtered_stations),
+            'wall_seconds': round(sum(timings.values()), 3),
+            'rows_per_second': round(rows / max(timings['weather_seconds'], 1e-9)),
+            # linux reports ru_maxrss in kilobytes
+            'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'timings': {name: round(seconds, 3) for name, seconds in timings.items()},
+            'metrics': populate_weather.METRICS.summary(),
+        }
+
+    finally:
+        if rate_limiter is not None:
+            rate_limiter.close()
+        db.close_pool()
+        server.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(RESULTS_FILE, 'a') as file_out:
+        file_out.write(json.dumps(result) + '\n')
+
+    print(json.dumps(result, indent=2))
+    return result
+
+
+
+
+if __name__ == "__main__":
+    '''
+    set variables
+    '''
+    port = 8765
+    stations = 50
+    # first date loaded, every station has data up to today
+    min_date = '2020-01-01'
+    workers = 4
+
+    # mock server: seconds per request (plus/minus jitter) and the share of 503 responses
+    latency = 0.05
+    jitter = 0.02
+    error_rate = 0.01
+
+    # calls per second allowed by the rate limiter, 4 / 1.1 is the real NOAA budget
+    rate = 1000.0
+
+    load_mode = 'copy'
+    storage_mode = 'compact'
+    # clustering resolution for filter_stations (0 - 9), None skips clustering
+    resolution = None
+    label = ''
+
+
+    run_benchmark(port, stations, min_date, workers, latency, jitter, error_rate, rate, load_mode, storage_mode, resolution, label)
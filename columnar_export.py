@@ -0,0 +1,241 @@
+import os
+import io
+import json
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import db
+import compact_storage
+
+
+
+# local columnar copy of the loaded observations (either storage mode) for analysis without going through Postgres
+# layout: hive partitioned Parquet, export/region=<region>/country=<cc>/year=<yyyy>/part-<watermark>.parquet
+# every append adds new parts, read_dataset reads only the columns and partitions asked for
+# any Parquet reader works on the directory too, e.g. pd.read_parquet('export'), _manifest.json is skipped by them
+# rows come out of Postgres with COPY ... TO STDOUT, one year at a time, instead of DictCursor rows
+
+EXPORT_DIR = 'export'
+COMPRESSION = 'zstd'
+
+# columns of every part file, region, country and year come from the directory names, obs_time -1 is missing
+SCHEMA = pa.schema([
+    ('station_id', pa.string()),
+    ('date', pa.date32()),
+    ('datatype', pa.string()),
+    ('value', pa.float32()),
+    ('mflag', pa.string()),
+    ('qflag', pa.string()),
+    ('sflag', pa.string()),
+    ('obs_time', pa.int16()),
+])
+COLUMNS = SCHEMA.names
+
+PARTITION_KEYS = ['region', 'country', 'year']
+
+# observations of every ledger window loaded after the last export, for one year, observations is the storage mode's OBSERVATIONS_SQL
+EXPORT_SQL = """COPY (SELECT coalesce(s.region, 'unknown') AS region, coalesce(s.country_code, 'unknown') AS country,
+    o.station_id, o.date::date AS date, o.datatype, o.value, coalesce(o.mflag, '') AS mflag, coalesce(o.qflag, '') AS qflag,
+    coalesce(o.sflag, '') AS sflag, coalesce(o.obs_time, -1) AS obs_time
+    FROM ({observations}) o
+    JOIN weather.weather_stations s USING (station_id)
+    WHERE o.date >= '{year}-01-01' AND o.date < '{next_year}-01-01'
+    AND EXISTS (SELECT 1 FROM weather.load_ledger l WHERE l.station_id = o.station_id
+                AND o.date BETWEEN l.start_date AND l.end_date
+                AND l.loaded_at > '{since}' AND l.loaded_at <= '{until}')
+    ) TO STDOUT WITH CSV HEADER"""
+
+# loaded_at is the loading transaction's start time, so a batch still running when the export starts commits
+# with loaded_at older than max(loaded_at), the watermark stops just before the oldest open transaction
+# (pg_stat_activity shows xact_start for sessions of the same database user, which the loaders are)
+WATERMARK_SQL = """SELECT least(coalesce((SELECT max(loaded_at) FROM weather.load_ledger), %s::timestamp),
+    (SELECT min(xact_start)::timestamp - interval '1 microsecond' FROM pg_stat_activity
+     WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL))::text"""
+
+YEARS_SQL = """SELECT DISTINCT y FROM weather.load_ledger l,
+    generate_series(extract(year FROM l.start_date)::int, extract(year FROM l.end_date)::int) AS y
+    WHERE l.loaded_at > %s AND l.loaded_at <= %s ORDER BY y"""
+
+
+
+
+def load_manifest(directory=EXPORT_DIR):
+    # {'watermark': load_ledger.loaded_at of the last exported window}
+    path = os.path.join(directory, '_manifest.json')
+
+    if os.path.exists(path):
+        with open(path, 'r') as file_in:
+            return json.load(file_in)
+
+    return {'watermark': '1900-01-01 00:00:00'}
+
+
+
+def save_manifest(manifest, directory=EXPORT_DIR):
+    path = os.path.join(directory, '_manifest.json')
+
+    with open(path + '.tmp', 'w') as file_out:
+        json.dump(manifest, file_out)
+
+    os.replace(path + '.tmp', path)
+    return
+
+
+
+def partition_path(directory, region, country, year):
+    return os.path.join(directory, f'region={region}', f'country={country}', f'year={year}')
+
+
+
+def write_part(path, part_name, frame):
+    # written to a hidden temp file and renamed, so a reader never sees half a part
+    tmp_path = os.path.join(path, f'.{part_name}.parquet.tmp')
+    table = pa.Table.from_pandas(frame[COLUMNS], schema=SCHEMA, preserve_index=False)
+    pq.write_table(table, tmp_path, compression=COMPRESSION)
+    os.replace(tmp_path, os.path.join(path, f'{part_name}.parquet'))
+    return
+
+
+
+def export_year(cursor, year, since, until, directory, part_name, storage_mode):
+    buffer = io.StringIO()
+    sql = EXPORT_SQL.format(observations=compact_storage.OBSERVATIONS_SQL[storage_mode], year=year, next_year=year + 1, since=since, until=until)
+    cursor.copy_expert(sql, buffer)
+    buffer.seek(0)
+
+    frame = pd.read_csv(buffer, keep_default_na=False, parse_dates=['date'],
+                        dtype={'region': str, 'country': str, 'station_id': str, 'datatype': str, 'value': np.float32,
+                               'mflag': str, 'qflag': str, 'sflag': str, 'obs_time': np.int16})
+
+    for (region, country), group in frame.groupby(['region', 'country'], sort=False):
+        path = partition_path(directory, region, country, year)
+        os.makedirs(path, exist_ok=True)
+        write_part(path, part_name, group)
+
+    return len(frame)
+
+
+
+def export_observations(directory=EXPORT_DIR, storage_mode='legacy'):
+    # appends every window loaded since the last export, the watermark only moves once all years are written
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    since = manifest['watermark']
+
+    with db.transaction() as cursor:
+        cursor.execute(WATERMARK_SQL, (since,))
+        until = cursor.fetchone()[0]
+        cursor.execute(YEARS_SQL, (since, until))
+        years = [row[0] for row in cursor.fetchall()]
+
+    if until <= since or not years:
+        print('Export is up to date')
+        return
+
+    part_name = 'part-' + datetime.fromisoformat(until).strftime('%Y%m%d%H%M%S%f')
+    exported = 0
+
+    for year in years:
+        with db.transaction() as cursor:
+            exported += export_year(cursor, year, since, until, directory, part_name, storage_mode)
+
+        print(f'Exported {year}: {exported} observations so far')
+
+    manifest['watermark'] = until
+    save_manifest(manifest, directory)
+    print(f'Export complete: {exported} observations in {len(years)} years')
+    return
+
+
+
+def matches(value, wanted):
+    return wanted is None or value in wanted
+
+
+
+def dataset_parts(directory=EXPORT_DIR, regions=None, countries=None, years=None):
+    # [(region, country, year, part_path)] for the partitions that pass the filters, oldest part first
+    parts = []
+
+    for region_dir in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        region = region_dir.partition('=')[2]
+        if not region_dir.startswith('region=') or not matches(region, regions):
+            continue
+
+        for country_dir in sorted(os.listdir(os.path.join(directory, region_dir))):
+            country = country_dir.partition('=')[2]
+            if not matches(country, countries):
+                continue
+
+            for year_dir in sorted(os.listdir(os.path.join(directory, region_dir, country_dir))):
+                year = int(year_dir.partition('=')[2])
+                if not matches(year, years):
+                    continue
+
+                path = os.path.join(directory, region_dir, country_dir, year_dir)
+                for part in sorted(os.listdir(path)):
+                    if part.startswith('part-') and part.endswith('.parquet'):
+                        parts.append((region, country, year, os.path.join(path, part)))
+
+    return parts
+
+
+
+def read_dataset(columns=None, regions=None, countries=None, years=None, datatypes=None, directory=EXPORT_DIR):
+    # DataFrame of the requested columns, only matching partitions are opened and only requested columns are read
+    # rows exported twice (refreshed windows) keep the value from the newest part
+    columns = list(COLUMNS) if columns is None else list(columns)
+    data_columns = [column for column in columns if column in COLUMNS]
+    key_columns = ['station_id', 'date', 'datatype']
+    read_columns = list(dict.fromkeys(data_columns + key_columns))
+    filters = None if datatypes is None else [('datatype', 'in', list(datatypes))]
+    frames = []
+
+    for region, country, year, path in dataset_parts(directory, regions, countries, years):
+        frame = pq.read_table(path, columns=read_columns, filters=filters).to_pandas(date_as_object=False)
+        for key, value in zip(PARTITION_KEYS, (region, country, year)):
+            if key in columns:
+                frame[key] = value
+
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    dataset = pd.concat(frames, ignore_index=True)
+    dataset = dataset.drop_duplicates(key_columns, keep='last')
+
+    for key in ('region', 'country'):
+        if key in columns:
+            dataset[key] = dataset[key].astype('category')
+
+    return dataset[columns].reset_index(drop=True)
+
+
+
+def regional_means(datatype, years=None, regions=None, directory=EXPORT_DIR):
+    # annual mean of one datatype per region, e.g. regional_means('TMAX')
+    dataset = read_dataset(['region', 'year', 'value'], regions=regions, years=years, datatypes=[datatype], directory=directory)
+    return dataset.groupby(['region', 'year'], observed=True)['value'].mean().unstack('year')
+
+
+
+
+if __name__ == "__main__":
+    # Connect to database
+    db.get_pool()
+
+
+    '''
+    set variables
+    '''
+    export_dir = EXPORT_DIR
+    # same as populate_weather.py
+    storage_mode = 'legacy'
+
+
+    export_observations(export_dir, storage_mode)
+
+    db.close_pool()
@@ -0,0 +1,217 @@
+from datetime import date
+import psycopg2
+import db
+
+
+
+# compact storage for observations, used by populate_weather.py when storage_mode = 'compact'
+# weather.observations is range partitioned by year, datatype is a smallint code from weather.datatype_codes
+# and the attributes string "mflag,qflag,sflag,time" is split into its own columns
+# weather.daily_core is the optional wide table, one row per station-day with the five core elements
+
+# years whose partitions are known to exist, read from the catalog once per process and checked before every batch
+# creating a partition takes an ACCESS EXCLUSIVE lock on the parent, so populate_weather.py creates the planned
+# years before loading starts and concurrent loading transactions only rarely create one themselves
+PARTITIONS = set()
+
+
+
+
+SCHEMA_SQL = """CREATE TABLE IF NOT EXISTS weather.datatype_codes (
+    datatype_id smallserial PRIMARY KEY,
+    datatype text NOT NULL UNIQUE);
+
+    CREATE TABLE IF NOT EXISTS weather.observations (
+    station_id text NOT NULL,
+    date date NOT NULL,
+    datatype_id smallint NOT NULL,
+    value real,
+    mflag char(1),
+    qflag char(1),
+    sflag char(1),
+    obs_time smallint,
+    PRIMARY KEY (station_id, date, datatype_id)) PARTITION BY RANGE (date);
+
+    CREATE TABLE IF NOT EXISTS weather.daily_core (
+    station_id text NOT NULL,
+    date date NOT NULL,
+    tmin real,
+    tmax real,
+    prcp real,
+    snow real,
+    snwd real,
+    PRIMARY KEY (station_id, date)) PARTITION BY RANGE (date)"""
+
+PARTITION_SQL = """CREATE TABLE IF NOT EXISTS weather.{table}_{year} PARTITION OF weather.{table}
+    FOR VALUES FROM ('{year}-01-01') TO ('{next_year}-01-01')"""
+
+# years that already have a partition in every table
+EXISTING_PARTITIONS_SQL = """SELECT right(c.relname, 4)::int FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+    JOIN pg_namespace n ON n.oid = p.relnamespace
+    WHERE n.nspname = 'weather' AND p.relname = ANY(%s)
+    GROUP BY 1 HAVING count(*) = %s"""
+
+# raw api values, converted set-based in the merge
+STAGE_SQL = """CREATE TEMP TABLE IF NOT EXISTS observation_stage
+    (station_id text, date text, datatype text, value text, attributes text) ON COMMIT DELETE ROWS"""
+
+COPY_SQL = "COPY observation_stage (station_id, date, datatype, value, attributes) FROM STDIN"
+
+CODES_SQL = """INSERT INTO weather.datatype_codes (datatype)
+    SELECT DISTINCT datatype FROM observation_stage ORDER BY datatype ON CONFLICT (datatype) DO NOTHING"""
+
+MERGE_SQL = """INSERT INTO weather.observations AS o (station_id, date, datatype_id, value, mflag, qflag, sflag, obs_time)
+    SELECT DISTINCT ON (s.station_id, s.date::date, c.datatype_id) s.station_id, s.date::date, c.datatype_id, s.value::real,
+    nullif(split_part(s.attributes, ',', 1), ''), nullif(split_part(s.attributes, ',', 2), ''), nullif(split_part(s.attributes, ',', 3), ''),
+    nullif(split_part(s.attributes, ',', 4), '')::smallint
+    FROM observation_stage s JOIN weather.datatype_codes c USING (datatype)
+    ORDER BY s.station_id, s.date::date, c.datatype_id
+    ON CONFLICT (station_id, date, datatype_id) DO UPDATE SET value = EXCLUDED.value,
+    mflag = EXCLUDED.mflag, qflag = EXCLUDED.qflag, sflag = EXCLUDED.sflag, obs_time = EXCLUDED.obs_time"""
+
+# a station-day split over two batches keeps the elements already loaded
+PIVOT_SQL = """INSERT INTO weather.daily_core AS d (station_id, date, tmin, tmax, prcp, snow, snwd)
+    SELECT station_id, date::date,
+    max(value::real) FILTER (WHERE datatype = 'TMIN'), max(value::real) FILTER (WHERE datatype = 'TMAX'),
+    max(value::real) FILTER (WHERE datatype = 'PRCP'), max(value::real) FILTER (WHERE datatype = 'SNOW'),
+    max(value::real) FILTER (WHERE datatype = 'SNWD')
+    FROM observation_stage WHERE datatype IN ('TMIN', 'TMAX', 'PRCP', 'SNOW', 'SNWD')
+    GROUP BY station_id, date::date
+    ON CONFLICT (station_id, date) DO UPDATE SET tmin = coalesce(EXCLUDED.tmin, d.tmin), tmax = coalesce(EXCLUDED.tmax, d.tmax),
+    prcp = coalesce(EXCLUDED.prcp, d.prcp), snow = coalesce(EXCLUDED.snow, d.snow), snwd = coalesce(EXCLUDED.snwd, d.snwd)"""
+
+# legacy weather.weather_usa_97 rows for one year, copied into the stage so they go through the same merge
+MIGRATE_SQL = """INSERT INTO observation_stage (station_id, date, datatype, value, attributes)
+    SELECT station_id, date::text, datatype, value::text, attributes FROM weather.weather_usa_97
+    WHERE date >= %s AND date < %s"""
+
+# observations of either storage mode with the compact columns, read by rollups.py and columnar_export.py
+# legacy dates stay timestamps so date ranges can still use the (station_id, date, datatype) key
+OBSERVATIONS_SQL = {
+    'compact': """SELECT o.station_id, o.date, c.datatype, o.value, o.mflag, o.qflag, o.sflag, o.obs_time
+        FROM weather.observations o JOIN weather.datatype_codes c USING (datatype_id)""",
+    'legacy': """SELECT station_id, date, datatype, value::real AS value, nullif(split_part(attributes, ',', 1), '') AS mflag,
+        nullif(split_part(attributes, ',', 2), '') AS qflag, nullif(split_part(attributes, ',', 3), '') AS sflag,
+        nullif(split_part(attributes, ',', 4), '')::smallint AS obs_time FROM weather.weather_usa_97""",
+}
+
+
+
+
+def create_schema(cursor):
+    cursor.execute(SCHEMA_SQL)
+    return
+
+
+
+def ensure_partitions(cursor, years, wide=True):
+    # yearly partitions for every year in the batch that does not have one yet
+    tables = ['observations', 'daily_core'] if wide else ['observations']
+
+    # first batch in this process, make sure the parent tables exist and pick up the partitions already there
+    if not PARTITIONS:
+        create_schema(cursor)
+        cursor.execute(EXISTING_PARTITIONS_SQL, (tables, len(tables)))
+        PARTITIONS.update(row[0] for row in cursor.fetchall())
+
+    for year in sorted(set(years) - PARTITIONS):
+        for table in tables:
+            # another process created it first, its transaction has committed by the time this one fails
+            cursor.execute('SAVEPOINT create_partition')
+
+            try:
+                cursor.execute(PARTITION_SQL.format(table=table, year=year, next_year=year + 1))
+                cursor.execute('RELEASE SAVEPOINT create_partition')
+
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                cursor.execute('ROLLBACK TO SAVEPOINT create_partition')
+
+    return
+
+
+
+def merge_stage(cursor, years, wide=True):
+    # observation_stage -> observations (and daily_core), the stage empties itself on commit
+    ensure_partitions(cursor, years, wide)
+    db.execute_prepared(cursor, 'compact_codes', CODES_SQL)
+    db.execute_prepared(cursor, 'compact_merge', MERGE_SQL)
+
+    if wide:
+        db.execute_prepared(cursor, 'compact_pivot', PIVOT_SQL)
+
+    return
+
+
+
+def load_compact(cursor, rows, wide=True):
+    # rows are (station_id, date, datatype, value, attributes) tuples as returned by the api
+    if not rows:
+        return
+
+    # small batches (row mode) are staged with prepared inserts, copy_compact is the COPY path
+    cursor.execute(STAGE_SQL)
+    db.execute_prepared(cursor, 'compact_stage', "INSERT INTO observation_stage VALUES ($1,$2,$3,$4,$5)", rows)
+    merge_stage(cursor, {int(row[1][:4]) for row in rows}, wide)
+    return
+
+
+
+def copy_compact(cursor, buffer, years, wide=True):
+    # buffer is the COPY text already built by load_data_bulk
+    cursor.execute(STAGE_SQL)
+    cursor.copy_expert(COPY_SQL, buffer)
+    merge_stage(cursor, years, wide)
+    return
+
+
+
+def commit_partitions(years):
+    # called once the loading transaction committed, a rolled back partition is created again next time
+    PARTITIONS.update(years)
+    return
+
+
+
+def migrate_legacy(first_year, last_year, wide=True):
+    # one transaction per year from weather.weather_usa_97, safe to re-run
+    # the load ledger is shared by both storage modes, so populate_weather.py can switch to compact afterwards
+    with db.transaction() as cursor:
+        create_schema(cursor)
+
+    for year in range(first_year, last_year + 1):
+        with db.transaction() as cursor:
+            cursor.execute(STAGE_SQL)
+            cursor.execute(MIGRATE_SQL, (f'{year}-01-01', f'{year + 1}-01-01'))
+            moved = cursor.rowcount
+
+            if moved:
+                merge_stage(cursor, [year], wide)
+
+        if moved:
+            commit_partitions([year])
+
+        print(f'Migrated {year}: {moved} observations')
+
+    return
+
+
+
+
+if __name__ == "__main__":
+    # Connect to database
+    db.get_pool()
+
+
+    '''
+    set variables
+    '''
+    # years of weather.weather_usa_97 to copy into weather.observations, run rollups.py afterwards
+    first_year = 1950
+    last_year = date.today().year
+    wide_rows = True
+
+
+    migrate_legacy(first_year, last_year, wide_rows)
+
+    db.close_pool()
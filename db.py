@@ -0,0 +1,158 @@
+import os
+import io
+import sys
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import DictCursor, execute_batch
+
+
+
+# shared database layer for populate_weather.py, populate_stations.py and add_cc_region_stations.py
+
+# LOCAL_DB_* settings by default, DB_TARGET=cloud reads the unprefixed DB_* ones for the cloud db
+db = '' if os.environ.get('DB_TARGET', 'local') == 'cloud' else 'LOCAL_'
+
+# Set variables
+DB_NAME = os.environ[f'{db}DB_NAME']
+DB_USER = os.environ[f'{db}DB_USER']
+DB_HOST = os.environ[f'{db}DB_HOST']
+DB_PASSWORD = os.environ[f'{db}DB_PASSWORD']
+
+# enough for the fetch engine's writer thread plus the main thread and a few workers
+# transaction() waits for a free connection beyond that, ThreadedConnectionPool itself raises PoolError
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 8
+
+POOL = None
+POOL_LOCK = threading.Lock()
+POOL_SLOTS = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # remembers which statements have been PREPAREd in this session
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+
+
+def get_pool():
+    global POOL
+
+    with POOL_LOCK:
+        if POOL is None:
+            connection_string = f'dbname={DB_NAME} user={DB_USER} host={DB_HOST} password={DB_PASSWORD}'
+
+            try:
+                POOL = ThreadedConnectionPool(MIN_CONNECTIONS, MAX_CONNECTIONS, connection_string, connection_factory=PooledConnection)
+                print('Database connection successful')
+
+            except:
+                sys.exit('Unable to connect to the database')
+
+    return POOL
+
+
+
+def close_pool():
+    global POOL
+
+    with POOL_LOCK:
+        if POOL is not None:
+            POOL.closeall()
+            POOL = None
+
+    return
+
+
+
+@contextmanager
+def transaction():
+    # one transaction on a pooled connection: commit when the block finishes, rollback if it raises
+    # safe to use from any thread, each block gets its own connection and cursor
+    pool = get_pool()
+    POOL_SLOTS.acquire()
+
+    try:
+        connection = pool.getconn()
+
+    except BaseException:
+        POOL_SLOTS.release()
+        raise
+
+    try:
+        with connection.cursor(cursor_factory=DictCursor) as cursor:
+            yield cursor
+        connection.commit()
+
+    except BaseException:
+        discard = connection.closed != 0
+
+        if not discard:
+            try:
+                # prepared statements are dropped too so the session is back to a known state
+                connection.rollback()
+                with connection.cursor() as cursor:
+                    cursor.execute('DEALLOCATE ALL')
+                connection.commit()
+                connection.prepared.clear()
+
+            except psycopg2.Error:
+                discard = True
+
+        pool.putconn(connection, close=discard)
+        connection = None
+        raise
+
+    finally:
+        if connection is not None:
+            pool.putconn(connection)
+        POOL_SLOTS.release()
+
+
+
+def copy_value(value):
+    # escape a value for COPY ... FROM STDIN text format
+    if value is None:
+        return '\\N'
+    
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+
+def copy_buffer(rows):
+    # rows as COPY text, ready for cursor.copy_expert
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row) + '\n')
+    buffer.seek(0)
+    return buffer
+
+
+
+def execute_prepared(cursor, name, sql, rows=((),)):
+    # PREPAREs sql ($1..$n placeholders) once per pooled connection, then EXECUTEs it for every row
+    # nothing is prepared for an empty batch, so the tables sql refers to do not have to exist yet
+    rows = list(rows)
+    if not rows:
+        return
+
+    connection = cursor.connection
+
+    if name not in connection.prepared:
+        cursor.execute(f'PREPARE {name} AS {sql}')
+        connection.prepared.add(name)
+
+    if not rows[0]:
+        cursor.execute(f'EXECUTE {name}')
+        return
+
+    placeholders = ','.join(['%s'] * len(rows[0]))
+    execute_batch(cursor, f'EXECUTE {name} ({placeholders})', rows, page_size=1000)
+    return
@@ -0,0 +1,88 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+import reverse_geocoder
+from scipy.spatial import cKDTree
+
+
+
+# prebuilt copy of reverse_geocoder's nearest-city lookup, saved once and reused on every run
+# cc.npy is memory-mapped, tree.pkl is the pickled KD-tree so it is never rebuilt
+# memo.json maps "lat,lon" -> [country_code, region] for coordinates already geocoded
+
+INDEX_DIR = 'geocode_index'
+RG_FILE = os.path.join(os.path.dirname(reverse_geocoder.__file__), 'rg_cities1000.csv')
+
+
+
+
+def build_index(directory=INDEX_DIR):
+    # keep_default_na=False so Namibia ('NA') stays a country code
+    cities = pd.read_csv(RG_FILE, usecols=['lat', 'lon', 'cc'], keep_default_na=False)
+    coords = cities[['lat', 'lon']].to_numpy(dtype=np.float64)
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'cc.npy'), cities['cc'].to_numpy(dtype='<U2'))
+
+    # same euclidean lat/lon tree reverse_geocoder builds, so results match reverse_geocoder.search
+    with open(os.path.join(directory, 'tree.pkl'), 'wb') as file_out:
+        pickle.dump(cKDTree(coords), file_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+    print(f'Geocode index built with {len(coords)} cities')
+    return
+
+
+
+def load_index(directory=INDEX_DIR):
+    # (tree, country codes), built on first use
+    if not os.path.exists(os.path.join(directory, 'tree.pkl')):
+        build_index(directory)
+
+    with open(os.path.join(directory, 'tree.pkl'), 'rb') as file_in:
+        tree = pickle.load(file_in)
+
+    country_codes = np.load(os.path.join(directory, 'cc.npy'), mmap_mode='r')
+    return tree, country_codes
+
+
+
+def country_codes_for(index, coords):
+    # nearest city's country code for every (lat, lon) row
+    tree, country_codes = index
+    _, nearest = tree.query(np.asarray(coords, dtype=np.float64), k=1)
+    return country_codes[nearest].tolist()
+
+
+
+def memo_key(latitude, longitude):
+    return f'{float(latitude)},{float(longitude)}'
+
+
+
+def load_memo(directory=INDEX_DIR):
+    path = os.path.join(directory, 'memo.json')
+
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as file_in:
+                return json.load(file_in)
+
+        except ValueError:
+            pass
+
+    return {}
+
+
+
+def save_memo(memo, directory=INDEX_DIR):
+    # written to a temp file first so a crash never leaves a half written memo
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'memo.json')
+
+    with open(path + '.tmp', 'w') as file_out:
+        json.dump(memo, file_out)
+
+    os.replace(path + '.tmp', path)
+    return
@@ -0,0 +1,226 @@
+import os
+import io
+import tarfile
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+import db
+import compact_storage
+import populate_weather
+
+
+
+# loads observations from NOAA's bulk GHCND files instead of the CDO api, no api calls at all
+# sources: a directory of <station>.dly or by_station <station>.csv(.gz) files, or the ghcnd_all.tar.gz tarball
+# https://www.ncei.noaa.gov/pub/data/ghcn/daily/
+# rows come out in the api's form and go through populate_weather.load_data_bulk, one ledger window per station
+
+DATATYPES = [b'TMIN', b'TMAX', b'PRCP', b'SNOW', b'SNWD']
+
+# .dly: 11 id, 4 year, 2 month, 4 element, then 31 days of 5 value + mflag + qflag + sflag, 269 characters
+DLY_WIDTH = 269
+DAYS = 31
+MISSING = -9999
+
+CSV_COLUMNS = ['station', 'date', 'datatype', 'value', 'mflag', 'qflag', 'sflag', 'obs_time']
+
+# populate_weather requests units=standard, archive values are tenths of C, tenths of mm and mm
+TEMPERATURES = ['TMIN', 'TMAX']
+SNOWFALL = ['SNOW', 'SNWD']
+
+
+
+
+def dly_records(buffer):
+    # (n, 269) uint8 matrix, one row per line, without a python loop when every line is full width
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+
+    if len(raw) % (DLY_WIDTH + 1) == 0 and (len(raw) == 0 or raw[DLY_WIDTH] == ord('\n')):
+        return raw.reshape(-1, DLY_WIDTH + 1)[:, :DLY_WIDTH]
+
+    # trimmed or \r\n lines, padded to full width with spaces
+    lines = np.array(bytes(buffer).splitlines(), dtype=f'S{DLY_WIDTH}')
+    lines = np.char.ljust(lines, DLY_WIDTH)
+    return np.frombuffer(lines.tobytes(), dtype=np.uint8).reshape(-1, DLY_WIDTH)
+
+
+
+def text_column(records, start, end):
+    return np.ascontiguousarray(records[:, start:end]).view(f'S{end - start}').ravel()
+
+
+
+def number_column(records, start, end):
+    digits = records[:, start:end].astype(np.int32) - ord('0')
+    return digits @ (10 ** np.arange(end - start - 1, -1, -1, dtype=np.int32))
+
+
+
+def parse_dly(buffer, datatypes=DATATYPES, mindate=None, maxdate=None):
+    # DataFrame of station, date, datatype, value, mflag, qflag, sflag for one .dly file (or several concatenated)
+    records = dly_records(buffer)
+    records = records[np.isin(text_column(records, 17, 21), datatypes)]
+
+    days = records[:, 21:21 + DAYS * 8].reshape(len(records), DAYS, 8)
+    values = np.ascontiguousarray(days[:, :, :5]).view('S5').reshape(len(records), DAYS).astype(np.int32)
+    present = values != MISSING
+
+    line, day = np.nonzero(present)
+    months = ((number_column(records, 11, 15) - 1970) * 12 + number_column(records, 15, 17) - 1).astype('datetime64[M]')
+    dates = months[line].astype('datetime64[D]') + day.astype('timedelta64[D]')
+
+    frame = pd.DataFrame({
+        'station': text_column(records, 0, 11)[line].astype(str),
+        'date': dates,
+        'datatype': text_column(records, 17, 21)[line].astype(str),
+        'value': values[line, day],
+        'mflag': days[line, day, 5].view('S1').astype(str),
+        'qflag': days[line, day, 6].view('S1').astype(str),
+        'sflag': days[line, day, 7].view('S1').astype(str),
+        'obs_time': '',
+    })
+
+    return clip_dates(frame, mindate, maxdate)
+
+
+
+def parse_csv(file_in, datatypes=DATATYPES, mindate=None, maxdate=None):
+    # by_station csv: ID,YYYYMMDD,ELEMENT,VALUE,MFLAG,QFLAG,SFLAG,OBS-TIME without a header
+    frame = pd.read_csv(file_in, header=None, names=CSV_COLUMNS, dtype=str, keep_default_na=False, compression='infer')
+    frame = frame[frame['datatype'].isin([datatype.decode() for datatype in datatypes])]
+    frame['date'] = pd.to_datetime(frame['date'], format='%Y%m%d')
+    frame['value'] = frame['value'].astype(np.int32)
+    return clip_dates(frame, mindate, maxdate)
+
+
+
+def clip_dates(frame, mindate, maxdate):
+    if mindate is not None:
+        frame = frame[frame['date'] >= np.datetime64(mindate)]
+    if maxdate is not None:
+        frame = frame[frame['date'] <= np.datetime64(maxdate)]
+    return frame
+
+
+
+def standard_units(frame):
+    # F, inches to hundredths (PRCP) and inches to tenths (SNOW, SNWD), rounded like the api
+    values = frame['value'].to_numpy(dtype=np.float64)
+    datatypes = frame['datatype'].to_numpy()
+
+    values = np.where(np.isin(datatypes, TEMPERATURES), np.round(values / 10 * 9 / 5 + 32), values)
+    values = np.where(datatypes == 'PRCP', np.round(values / 254, 2), values)
+    values = np.where(np.isin(datatypes, SNOWFALL), np.round(values / 25.4, 1), values)
+    return values
+
+
+
+def api_rows(frame):
+    # (station_id, date, datatype, value, attributes) as the cdo api returns them, built column-wise
+    flags = [frame[column].str.strip() for column in ('mflag', 'qflag', 'sflag')]
+    attributes = flags[0] + ',' + flags[1] + ',' + flags[2] + ',' + frame['obs_time']
+
+    return list(zip('GHCND:' + frame['station'], frame['date'].dt.strftime('%Y-%m-%dT00:00:00'),
+                    frame['datatype'], standard_units(frame).tolist(), attributes))
+
+
+
+def archive_files(source, station_ids):
+    # yields (station_id, parser, buffer or file) for the wanted stations found in source
+    wanted = {station_id.split(':')[-1] for station_id in station_ids}
+
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            station = name[:11]
+            path = os.path.join(source, name)
+
+            if station not in wanted:
+                continue
+
+            if name.endswith('.dly') and os.path.getsize(path):
+                yield station, parse_dly, np.memmap(path, dtype=np.uint8, mode='r')
+            elif name.endswith('.csv') or name.endswith('.csv.gz'):
+                yield station, parse_csv, path
+
+        return
+
+    with tarfile.open(source, 'r:*') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            station = name[:11]
+
+            if not member.isfile() or station not in wanted:
+                continue
+
+            if name.endswith('.dly'):
+                yield station, parse_dly, tar.extractfile(member).read()
+            elif name.endswith('.csv') or name.endswith('.csv.gz'):
+                yield station, parse_csv, io.BytesIO(tar.extractfile(member).read())
+
+
+
+def load_archive(source, filtered_stations, mindate, maxdate, datatypes=DATATYPES):
+    # every wanted station in the archive is loaded between its own min/max date and mindate/maxdate
+    # its ledger window commits with its last batch, so the api planner skips it afterwards
+    stations = {station_result[0].split(':')[-1]: station_result for station_result in filtered_stations}
+
+    # the api planner may never have run on this database
+    with db.transaction() as cursor:
+        populate_weather.create_load_tables(cursor)
+        years = populate_weather.create_partitions(cursor, mindate, maxdate)
+
+    compact_storage.commit_partitions(years)
+    rows = []
+    windows = []
+    loaded = 0
+
+    for station, parser, data in archive_files(source, stations):
+        station_result = stations[station]
+        start = max(station_result[3], mindate)
+        end = min(station_result[4], maxdate)
+
+        if start > end:
+            continue
+
+        rows += api_rows(parser(data, datatypes, start, end))
+        windows.append((station_result[0], str(start), str(end)))
+        loaded += 1
+
+        if len(rows) >= populate_weather.batch_size:
+            populate_weather.load_data_bulk(rows, (), windows)
+            print(f'Loaded {loaded} stations from {source}')
+            rows = []
+            windows = []
+
+    if rows or windows:
+        populate_weather.load_data_bulk(rows, (), windows)
+
+    print(f'Loaded {loaded} of {len(stations)} stations from {source}')
+    return
+
+
+
+
+if __name__ == "__main__":
+    # Connect to database
+    db.get_pool()
+
+
+    '''
+    set variables
+    '''
+    populate_weather.set_variables()
+
+    # directory of .dly / by_station csv files or the ghcnd_all.tar.gz tarball
+    source = 'ghcnd_all.tar.gz'
+
+    min_date = datetime.strptime('1950-01-01', '%Y-%m-%d').date()
+    max_date = date.today()
+
+
+    filtered_stations = populate_weather.filter_stations(create_station_html=False)
+    load_archive(source, filtered_stations, min_date, max_date)
+    populate_weather.roll_up_regions()
+
+    populate_weather.RATE_LIMITER.close()
+    db.close_pool()
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+
+
+# in-process counters, gauges and histograms for populate_weather.py
+# summary() is the periodic progress line, write_textfile() the Prometheus textfile (node_exporter textfile collector)
+
+PREFIX = 'noaa'
+
+# seconds, for request latency, rate limit waits, decode and database writes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# pages fetched by one paginated request
+PAGE_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        # name -> [bucket counts, sum, count, buckets]
+        self.histograms = {}
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        return
+
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+        return
+
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(buckets), 0.0, 0, buckets]
+
+            for index, bound in enumerate(histogram[3]):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+
+            histogram[1] += value
+            histogram[2] += 1
+
+        return
+
+
+    def total(self, name):
+        # seconds (or units) observed so far under a histogram name
+        with self.lock:
+            histogram = self.histograms.get(name)
+            return (histogram[1], histogram[2]) if histogram else (0.0, 0)
+
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        request_seconds, requests = self.total('request_seconds')
+        wait_seconds, _ = self.total('rate_limit_wait_seconds')
+        decode_seconds, _ = self.total('decode_seconds')
+        write_seconds, _ = self.total('write_seconds')
+        _, cache_hits = self.total('cache_seconds')
+
+        with self.lock:
+            rows = self.counters.get('rows_written', 0)
+            pages = self.counters.get('pages', 0)
+            failures = self.counters.get('failures', 0)
+            quota = self.gauges.get('quota_remaining')
+
+        return (f'{round(elapsed)}s | requests {requests} (avg {round(request_seconds / max(requests, 1), 3)}s, {cache_hits} cached) | '
+                f'pages {pages} | failures {failures} | fetch {round(request_seconds)}s rate limit {round(wait_seconds)}s '
+                f'decode {round(decode_seconds)}s write {round(write_seconds)}s | rows {rows} ({round(rows / max(elapsed, 1e-9))}/s) | '
+                f'quota left {quota}')
+
+
+    def textfile(self):
+        lines = []
+
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE {PREFIX}_{name}_total counter', f'{PREFIX}_{name}_total {value}']
+
+            for name, value in sorted(self.gauges.items()):
+                lines += [f'# TYPE {PREFIX}_{name} gauge', f'{PREFIX}_{name} {value}']
+
+            for name, (counts, total, count, buckets) in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {PREFIX}_{name} histogram')
+                cumulative = 0
+
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{PREFIX}_{name}_bucket{{le="{bound}"}} {cumulative}')
+
+                lines += [f'{PREFIX}_{name}_bucket{{le="+Inf"}} {count}', f'{PREFIX}_{name}_sum {total}', f'{PREFIX}_{name}_count {count}']
+
+        lines.append(f'{PREFIX}_uptime_seconds {time.time() - self.started}')
+        return '\n'.join(lines) + '\n'
+
+
+    def write_textfile(self, path):
+        # written to a temp file first so the collector never reads half a file
+        with open(path + '.tmp', 'w') as file_out:
+            file_out.write(self.textfile())
+
+        os.replace(path + '.tmp', path)
+        return
+
+
+
+
+def start_reporting(report, interval=60.0):
+    # calls report() every interval seconds on a daemon thread, set the returned event to stop
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            report()
+
+    threading.Thread(target=run, name='metrics-reporter', daemon=True).start()
+    return stop
@@ -0,0 +1,178 @@
+import json
+import math
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+
+# local stand-in for the NOAA CDO v2 /stations and /data endpoints, used by benchmark.py
+# pages are synthetic but deterministic: same catalog, same values and same page layout on every run
+# latency and the 503 rate are configurable, /stats returns the request counts served so far
+
+API_PATH = '/cdo-web/api/v2'
+
+
+
+
+class MockCDOServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, stations=100, latency=0.05, jitter=0.02, error_rate=0.0, seed=0):
+        super().__init__(address, MockCDOHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'stations_requests': 0, 'data_requests': 0, 'errors': 0, 'rows': 0}
+
+        # catalog: contiguous US stations from before 1950 to today, full coverage, so filter_stations keeps them all
+        generator = random.Random(seed)
+        self.catalog = [{'id': f'GHCND:USBENCH{number:05d}', 'name': f'BENCHMARK STATION {number}, US',
+                         'latitude': round(generator.uniform(25.0, 49.0), 4), 'longitude': round(generator.uniform(-124.0, -67.0), 4),
+                         'elevation': round(generator.uniform(0, 3000), 1), 'elevationUnit': 'METERS',
+                         'mindate': '1949-01-01', 'maxdate': str(date.today()), 'datacoverage': 1}
+                        for number in range(stations)]
+        self.station_index = {station['id']: number for number, station in enumerate(self.catalog)}
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+        return
+
+
+    def failed(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+    def stations_page(self, params):
+        limit = int(params.get('limit', ['25'])[0])
+        offset = int(params.get('offset', ['1'])[0])
+        results = self.catalog[offset - 1:offset - 1 + limit]
+
+        if not results:
+            return {}
+
+        return {'metadata': {'resultset': {'offset': offset, 'count': len(self.catalog), 'limit': limit}}, 'results': results}
+
+
+    def data_page(self, params):
+        # results are ordered by date, then datatype, then station, like the real endpoint
+        stations = [station_id for station_id in params.get('stationid', []) if station_id in self.station_index]
+        datatypes = params.get('datatypeid', ['TMIN,TMAX,PRCP,SNOW,SNWD'])[0].split(',')
+        start = date.fromisoformat(params['startdate'][0][:10])
+        end = date.fromisoformat(params['enddate'][0][:10])
+        limit = int(params.get('limit', ['25'])[0])
+        offset = int(params.get('offset', ['1'])[0])
+
+        per_day = len(stations) * len(datatypes)
+        count = max((end - start).days + 1, 0) * per_day
+
+        if offset > count:
+            return {}
+
+        results = []
+        for index in range(offset - 1, min(count, offset - 1 + limit)):
+            day, position = divmod(index, per_day)
+            datatype, station = divmod(position, len(stations))
+            current = start + timedelta(days=day)
+            results.append({'date': current.isoformat() + 'T00:00:00', 'datatype': datatypes[datatype], 'station': stations[station],
+                            'attributes': ',,7,0700', 'value': synthetic_value(datatypes[datatype], self.station_index[stations[station]], current)})
+
+        return {'metadata': {'resultset': {'offset': offset, 'count': count, 'limit': limit}}, 'results': results}
+
+
+
+
+def synthetic_value(datatype, station_number, day):
+    # seasonal temperatures in F, occasional rain and winter snow in inches
+    season = math.sin(2 * math.pi * (day.timetuple().tm_yday - 105) / 365.25)
+    noise = ((station_number * 7919 + day.toordinal() * 104729) % 1000) / 1000
+
+    if datatype == 'TMAX':
+        return round(60 + 25 * season + 10 * noise - station_number % 10)
+    if datatype == 'TMIN':
+        return round(40 + 22 * season + 10 * noise - station_number % 10)
+    if datatype == 'PRCP':
+        return round(noise * 1.5, 2) if noise > 0.7 else 0.0
+    if datatype == 'SNOW':
+        return round(noise * 4, 1) if season < -0.5 and noise > 0.8 else 0.0
+    return round(noise * 10, 1) if season < -0.7 else 0.0
+
+
+
+
+class MockCDOHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        server = self.server
+
+        if url.path == API_PATH + '/stats':
+            with server.lock:
+                return self.send_json(200, dict(server.stats))
+
+        time.sleep(max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter)))
+
+        if url.path == API_PATH + '/stations':
+            server.count('stations_requests')
+            body = server.stations_page(params)
+        elif url.path == API_PATH + '/data':
+            server.count('data_requests')
+            body = server.data_page(params)
+        else:
+            return self.send_json(404, {'message': 'not found'})
+
+        if server.failed():
+            server.count('errors')
+            return self.send_json(503, {'message': 'Service Unavailable'})
+
+        server.count('rows', len(body.get('results', [])))
+        return self.send_json(200, body)
+
+
+    def send_json(self, status_code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        return
+
+
+    def log_message(self, format, *args):
+        return
+
+
+
+
+def serve(port=8765, stations=100, latency=0.05, jitter=0.02, error_rate=0.0, seed=0):
+    server = MockCDOServer(('127.0.0.1', port), stations, latency, jitter, error_rate, seed)
+    print(f'Mock CDO server on http://127.0.0.1:{port}{API_PATH} with {stations} stations')
+    server.serve_forever()
+    return
+
+
+
+
+if __name__ == "__main__":
+    '''
+    set variables
+    '''
+    port = 8765
+    stations = 100
+    # seconds per request (plus/minus jitter) and the share of requests answered with a 503
+    latency = 0.05
+    jitter = 0.02
+    error_rate = 0.01
+
+
+    serve(port, stations, latency, jitter, error_rate)
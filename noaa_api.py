@@ -0,0 +1,170 @@
+import os
+import random
+import time
+import orjson
+import requests
+from db import execute_prepared
+
+
+
+# shared NOAA CDO request helpers for populate_weather.py and populate_stations.py
+
+# NOAA_API_URL points the scripts at another CDO server (benchmark.py's local mock)
+API_URL = os.environ.get('NOAA_API_URL', 'https://www.ncdc.noaa.gov/cdo-web/api/v2')
+PAGE_SIZE = 1000
+
+# status codes worth re-requesting, None is a request that never got a response
+# 200 only shows up here when the body was not valid json
+RETRY_STATUS_CODES = {None, 200, 429}
+
+
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    # exponential backoff with full jitter: 0 - base * 2^attempt seconds, capped
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+
+def decode(body):
+    # orjson parses the raw utf-8 bytes straight into python objects, several times faster than json.loads
+    return orjson.loads(body)
+
+
+
+def fetch_json(url, header, retries=4, before_request=None, timeout=120, cache=None, observe=None):
+    # returns (status_code, json_results), json_results is None when every attempt failed
+    # before_request(url) is called ahead of each attempt (rate limiting)
+    # cache hits are served without a request, so they cost no api calls
+    # the cache keeps the raw response body, pages are only ever decoded once and never re-serialized
+    # observe(name, seconds) receives cache_seconds, request_seconds and decode_seconds timings
+    if cache is not None:
+        started = time.perf_counter()
+        body = cache.get(url)
+
+        if body is not None:
+            try:
+                json_results = decode(body)
+
+                if observe is not None:
+                    observe('cache_seconds', time.perf_counter() - started)
+                return 200, json_results
+
+            except orjson.JSONDecodeError:
+                pass
+
+    for attempt in range(1, retries + 1):
+        if before_request is not None:
+            before_request(url)
+
+        started = time.perf_counter()
+
+        try:
+            response = requests.get(url, headers=header, timeout=timeout)
+            status_code = response.status_code
+
+        except requests.RequestException:
+            status_code = None
+
+        if observe is not None:
+            observe('request_seconds', time.perf_counter() - started)
+
+        if status_code == 200:
+            try:
+                started = time.perf_counter()
+                json_results = decode(response.content)
+
+                if observe is not None:
+                    observe('decode_seconds', time.perf_counter() - started)
+
+                if cache is not None:
+                    cache.put(url, response.content)
+
+                return status_code, json_results
+
+            except orjson.JSONDecodeError:
+                pass
+
+        if status_code not in RETRY_STATUS_CODES and not 500 <= status_code < 600:
+            return status_code, None
+
+        if attempt < retries:
+            time.sleep(backoff_delay(attempt))
+
+    return status_code, None
+
+
+
+def result_count(json_results):
+    return json_results.get('metadata', {}).get('resultset', {}).get('count', 0)
+
+
+
+def iterate_pages(url_pre, header, offset=1, retries=4, before_request=None, cache=None, row_factory=None, observe=None):
+    # iterative page walk, yields (offset, status_code, json_results) for each page
+    # stops after the last page or after the first page that could not be fetched
+    # row_factory(results) replaces the page's result dicts with compact rows before the page is handed on
+    while True:
+        status_code, json_results = fetch_json(url_pre + str(offset), header, retries, before_request, cache=cache, observe=observe)
+
+        if row_factory is not None and json_results is not None and 'results' in json_results:
+            json_results['results'] = row_factory(json_results['results'])
+
+        yield offset, status_code, json_results
+
+        if json_results is None:
+            return
+
+        offset += PAGE_SIZE
+        if offset > result_count(json_results):
+            return
+
+
+
+# progress checkpoints, one row per paginated request (url without the offset value)
+# next_offset is the first page not yet committed to the database
+
+PROGRESS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS weather.load_progress (
+    request_key text PRIMARY KEY,
+    next_offset integer NOT NULL,
+    result_count integer NOT NULL,
+    completed boolean NOT NULL DEFAULT false,
+    updated_at timestamp NOT NULL DEFAULT now())"""
+
+CHECKPOINT_SQL = """INSERT INTO weather.load_progress (request_key, next_offset, result_count, completed)
+    VALUES ($1,$2,$3,$4) ON CONFLICT (request_key) DO UPDATE SET
+    next_offset = EXCLUDED.next_offset, result_count = EXCLUDED.result_count, completed = EXCLUDED.completed, updated_at = now()"""
+
+
+
+
+def create_progress_table(cursor):
+    cursor.execute(PROGRESS_TABLE_SQL)
+    return
+
+
+
+def load_checkpoints(cursor):
+    # {request_key: (next_offset, completed)}
+    cursor.execute("SELECT request_key, next_offset, completed FROM weather.load_progress")
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
+
+def page_checkpoint(url_pre, offset, json_results):
+    # checkpoint to store once the page fetched at `offset` is committed
+    count = result_count(json_results)
+    next_offset = offset + PAGE_SIZE
+    return (url_pre, next_offset, count, next_offset > count)
+
+
+
+def save_checkpoints(cursor, checkpoints):
+    execute_prepared(cursor, 'save_checkpoint', CHECKPOINT_SQL, checkpoints)
+    return
+
+
+
+def clear_checkpoint(cursor, url_pre):
+    cursor.execute("DELETE FROM weather.load_progress WHERE request_key = %s", (url_pre,))
+    return
@@ -1,25 +1,18 @@
 import os
-import psycopg2
-from psycopg2.extras import DictCursor
-import requests
-import json
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db
+from rate_limiter import TokenBucket, DailyLimitExceeded
+from response_cache import ResponseCache
+from noaa_api import API_URL, fetch_json, result_count, iterate_pages, create_progress_table, load_checkpoints, page_checkpoint, save_checkpoints, clear_checkpoint, PAGE_SIZE
 
 
 
-# Comment out line 12 when loading cloud db (future)
-db = ''
-db = db + 'LOCAL_'
-
-# Set variables
-DB_NAME = os.environ[f'{db}DB_NAME']
-DB_USER = os.environ[f'{db}DB_USER']
-DB_HOST = os.environ[f'{db}DB_HOST']
-DB_PASSWORD = os.environ[f'{db}DB_PASSWORD']
+# Set variables (database settings are in db.py)
 NOAA_TOKEN = os.environ['NOAA_TOKEN']
 
 header = {'token': NOAA_TOKEN}
-base_url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/stations'
+base_url = API_URL + '/stations'
 # base_url = "https://www.ncei.noaa.gov/access/services/data/v1" alternative possiblity - have not checked
 dataset_id = '?datasetid=GHCND'
 limit = '&limit=1000'
@@ -27,91 +20,166 @@ limit = '&limit=1000'
 
 
 
-def db_connect():
-    connection_string = f'dbname={DB_NAME} user={DB_USER} host={DB_HOST} password={DB_PASSWORD}'
+# a station that moved gets its country_code/region cleared so add_cc_region_stations.py geocodes it again
+UPSERT_SQL = """INSERT INTO weather.weather_stations AS s
+    (station_id, name, latitude, longitude, elevation, elevation_unit, country_code, region, min_date, max_date, data_coverage)
+    VALUES ($1,$2,$3,$4,$5,$6,NULL,NULL,$7,$8,$9) ON CONFLICT (station_id) DO UPDATE SET
+    country_code = CASE WHEN (s.latitude, s.longitude) IS DISTINCT FROM (EXCLUDED.latitude, EXCLUDED.longitude) THEN NULL ELSE s.country_code END,
+    region = CASE WHEN (s.latitude, s.longitude) IS DISTINCT FROM (EXCLUDED.latitude, EXCLUDED.longitude) THEN NULL ELSE s.region END,
+    name=EXCLUDED.name,latitude=EXCLUDED.latitude,longitude=EXCLUDED.longitude,elevation=EXCLUDED.elevation,
+    elevation_unit=EXCLUDED.elevation_unit,min_date=EXCLUDED.min_date,max_date=EXCLUDED.max_date,data_coverage=EXCLUDED.data_coverage"""
+
+# delta sync: the whole catalog is staged with COPY and only new or changed stations are written
+STAGE_SQL = """CREATE TEMP TABLE IF NOT EXISTS station_stage
+    (LIKE weather.weather_stations INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"""
+
+COPY_SQL = """COPY station_stage (station_id, name, latitude, longitude, elevation, elevation_unit, min_date, max_date, data_coverage)
+    FROM STDIN"""
+
+DELTA_SQL = """INSERT INTO weather.weather_stations AS s
+    (station_id, name, latitude, longitude, elevation, elevation_unit, country_code, region, min_date, max_date, data_coverage)
+    SELECT DISTINCT ON (station_id) station_id, name, latitude, longitude, elevation, elevation_unit, NULL, NULL, min_date, max_date, data_coverage
+    FROM station_stage ORDER BY station_id
+    ON CONFLICT (station_id) DO UPDATE SET
+    country_code = CASE WHEN (s.latitude, s.longitude) IS DISTINCT FROM (EXCLUDED.latitude, EXCLUDED.longitude) THEN NULL ELSE s.country_code END,
+    region = CASE WHEN (s.latitude, s.longitude) IS DISTINCT FROM (EXCLUDED.latitude, EXCLUDED.longitude) THEN NULL ELSE s.region END,
+    name=EXCLUDED.name,latitude=EXCLUDED.latitude,longitude=EXCLUDED.longitude,elevation=EXCLUDED.elevation,
+    elevation_unit=EXCLUDED.elevation_unit,min_date=EXCLUDED.min_date,max_date=EXCLUDED.max_date,data_coverage=EXCLUDED.data_coverage
+    WHERE (s.max_date, s.data_coverage, s.min_date, s.name, s.latitude, s.longitude, s.elevation, s.elevation_unit)
+    IS DISTINCT FROM (EXCLUDED.max_date, EXCLUDED.data_coverage, EXCLUDED.min_date, EXCLUDED.name, EXCLUDED.latitude,
+    EXCLUDED.longitude, EXCLUDED.elevation, EXCLUDED.elevation_unit)"""
 
+
+
+def rate_limit_check(url):
+    # same token bucket (api_calls.sqlite) as populate_weather.py, so both scripts share the budget
     try:
-        connection = psycopg2.connect(connection_string)
-        connection.autocommit = True
-        print('Database connection successful')
-    
-    except:
-        sys.exit('Unable to connect to the database')
+        RATE_LIMITER.acquire()
 
-    cursor = connection.cursor(cursor_factory=DictCursor)
-    return cursor
+    except DailyLimitExceeded as hours:
+        print(f'10,000 calls per day limit reached in {hours} hours')
+        sys.exit()
 
+    return
 
 
-def load_db(json_response):
-    for result in json_response['results']:
-        
-        try:
-            insert_sql = """INSERT INTO weather.weather_stations
-                (station_id, name, latitude, longitude, elevation, elevation_unit, country_code, region, min_date, max_date, data_coverage)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (station_id) DO UPDATE SET
-                name=%s,latitude=%s,longitude=%s,elevation=%s,elevation_unit=%s,min_date=%s,max_date=%s,data_coverage=%s"""
-            
-            cursor.execute(insert_sql, (result['id'], result['name'], result['latitude'], result['longitude'], result.get('elevation'),\
-                            result.get('elevationUnit'), None, None, result['mindate'], result['maxdate'], result['datacoverage'],\
-                            result['name'], result['latitude'], result['longitude'], result.get('elevation'), result.get('elevationUnit'),\
-                            result['mindate'], result['maxdate'], result['datacoverage']))
-
-        except:
-            cursor.close()
-            sys.exit('Unable to load database')
+
+def station_rows(results):
+    # applied by iterate_pages, the page's dicts are dropped as soon as the rows are built
+    return [(result['id'], result['name'], result['latitude'], result['longitude'], result.get('elevation'), result.get('elevationUnit'),\
+            result['mindate'], result['maxdate'], result['datacoverage']) for result in results]
+
+
+
+def load_db(rows, checkpoint):
+    # one transaction per page, the page checkpoint commits with the stations
+    try:
+        with db.transaction() as cursor:
+            db.execute_prepared(cursor, 'upsert_station', UPSERT_SQL, rows)
+            save_checkpoints(cursor, [checkpoint])
+
+    except:
+        db.close_pool()
+        sys.exit('Unable to load database')
     return
 
 
 
-def load_weather_stations(entry_number=1, attempts=1):
-    offset = f'&offset={entry_number}'
-    url = base_url + dataset_id + limit + offset
+
+def load_weather_stations(entry_number=1):
+    url_pre = base_url + dataset_id + limit + '&offset='
     retries = 4
 
-    # Make request to NOAA API
-    try:
-        response = requests.get(url, headers=header)
-        status_code = response.status_code
-        
-        if status_code == 200:
-            json_response = response.json()
-            num_results = json_response['metadata']['resultset']['count']
-            
-            # Need to reset attempts here for next API call
-            attempts = 1
+    # resume an interrupted catalog load at the last committed page
+    with db.transaction() as cursor:
+        create_progress_table(cursor)
+        next_offset, completed = load_checkpoints(cursor).get(url_pre, (entry_number, False))
 
-            # This is a recursive function - only want to see number of results at the beginning
-            if entry_number == 1:
-                print(f"Number of stations: {num_results}")
+    if not completed and next_offset > 1:
+        entry_number = next_offset
+        print(f'Resuming at entry {entry_number}')
 
-            
-            load_db(json_response)
+    # Make request to NOAA API, iterate_pages re-requests 5xx responses with backoff
+    for entry_number, status_code, json_response in iterate_pages(url_pre, header, entry_number, retries, rate_limit_check, cache=RESPONSE_CACHE, row_factory=station_rows):
         
-            entry_number += 1000
-            # using min here for the last call which is typically less than 1000 entries
-            print(f'Loaded {min(entry_number - 1, num_results)} entries')     
+        if json_response is None:
+            if status_code is None:
+                print('NOAA request failed')
+            else:
+                print(f'Exiting with status code: {status_code}')
             
-            if (entry_number <= num_results):
-                load_weather_stations(entry_number, attempts)
+            return
         
-        # API is a bit glitchy at times, usually just need to re-request
-        elif status_code == 503:
-            print(f'Status code: {status_code}')
-
-            if attempts < retries:
-                attempts += 1
-                print(f'Attempt number {attempts} initiating...')
-                load_weather_stations(entry_number, attempts)
-            
+        num_results = json_response['metadata']['resultset']['count']
+
+        # only want to see number of results at the beginning
+        if entry_number == 1:
+            print(f"Number of stations: {num_results}")
+
+        checkpoint = page_checkpoint(url_pre, entry_number, json_response)
+        load_db(json_response['results'], checkpoint)
+
+        # using min here for the last call which is typically less than 1000 entries
+        print(f'Loaded {min(checkpoint[1] - 1, num_results)} entries')
+    
+    # full catalog loaded, next run starts from the beginning again
+    with db.transaction() as cursor:
+        clear_checkpoint(cursor, url_pre)
+    return
+
+
+
+def fetch_page(url_pre, offset):
+    status_code, json_response = fetch_json(url_pre + str(offset), header, retries, rate_limit_check, cache=RESPONSE_CACHE)
+
+    if json_response is None:
+        return offset, status_code, None, 0
+
+    return offset, status_code, station_rows(json_response.get('results', [])), result_count(json_response)
+
+
+
+def sync_weather_stations(workers=4):
+    # delta sync: first page gives the catalog size, the other pages are fetched concurrently within the rate limit
+    # then one COPY + one upsert that only touches stations whose catalog entry changed
+    url_pre = base_url + dataset_id + limit + '&offset='
+
+    offset, status_code, rows, num_results = fetch_page(url_pre, 1)
+    if rows is None:
+        print(f'Exiting with status code: {status_code}')
+        return
+
+    print(f"Number of stations: {num_results}")
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_page, url_pre, offset) for offset in range(1 + PAGE_SIZE, num_results + 1, PAGE_SIZE)]
+
+        for future in as_completed(futures):
+            offset, status_code, page_rows, _ = future.result()
+
+            if page_rows is None:
+                failed.append(offset)
+                print(f'Page at entry {offset} failed with status code: {status_code}')
             else:
-                print(f'Failed {retries} attempts')
-        
-        else:
-            print(f'Exiting with status code: {status_code}')
-                
+                rows += page_rows
+
+    try:
+        with db.transaction() as cursor:
+            cursor.execute(STAGE_SQL)
+            cursor.copy_expert(COPY_SQL, db.copy_buffer(rows))
+            cursor.execute(DELTA_SQL)
+            changed = cursor.rowcount
+
     except:
-        print('NOAA request failed')
+        db.close_pool()
+        sys.exit('Unable to load database')
+
+    print(f'Fetched {len(rows)} stations, {changed} new or changed stations written')
+
+    # cached pages make the rerun cheap, only the failed pages cost api calls again
+    if failed:
+        print(f'{len(failed)} pages failed, run again to finish the sync')
     return
 
 
@@ -119,9 +187,24 @@ def load_weather_stations(entry_number=1, attempts=1):
 
 if __name__ == "__main__":
     # Connect to database
-    cursor = db_connect()
+    db.get_pool()
+
+    # shared with populate_weather.py, catalog pages are reused for a day
+    RESPONSE_CACHE = ResponseCache('noaa_cache')
+    RATE_LIMITER = TokenBucket(NOAA_TOKEN)
+    retries = 4
+
+    # delta_sync True fetches the catalog pages concurrently and writes only changed stations
+    # delta_sync False is the original sequential load with a checkpoint after every page
+    delta_sync = True
+    workers = 4
+
+    if delta_sync:
+        sync_weather_stations(workers)
+    else:
+        # Loads weather station data (1000 at a time) into database
+        load_weather_stations()
 
-    # Loads weather station data (1000 at a time) into database
-    load_weather_stations()
+    RATE_LIMITER.close()
 
-    cursor.close()
+    db.close_pool()
@@ -1,16 +1,29 @@
 import os
-import psycopg2
-from psycopg2.extras import DictCursor
-import requests
 import json
 import time
+import operator
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
+import math
 import pandas as pd
 import numpy as np
 from sklearn.cluster import DBSCAN
 import folium
-from datetime import date, datetime
+from folium.plugins import FastMarkerCluster
+from matplotlib import colormaps
+from datetime import date, datetime, timedelta
+from urllib.parse import urlparse, parse_qs
 from loguru import logger
+from psycopg2.extras import execute_values
+import db
+import compact_storage
+import rollups
+from rate_limiter import TokenBucket, DailyLimitExceeded
+from response_cache import ResponseCache
+from metrics import Metrics, start_reporting, PAGE_BUCKETS
+from noaa_api import API_URL, iterate_pages, create_progress_table, load_checkpoints, page_checkpoint, save_checkpoints, PAGE_SIZE
 
 
 
@@ -35,8 +48,9 @@ def add_serialization(record):
 logger.remove()
 logger = logger.patch(add_serialization)
 
-logger.add("populate_weather_log.json", format="{extra[json_output]}")
-logger.add(sys.stderr, format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <yellow>{level}</yellow> | <cyan>line: {line}</cyan> | <cyan>{message}</cyan>")
+# enqueue=True hands records to a background writer, fetch threads never wait on file or terminal writes
+logger.add("populate_weather_log.json", format="{extra[json_output]}", enqueue=True)
+logger.add(sys.stderr, format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <yellow>{level}</yellow> | <cyan>line: {line}</cyan> | <cyan>{message}</cyan>", enqueue=True)
 
 script_run_datetime = time.time()
 script_logger = logger.bind(script_run_datetime=script_run_datetime)
@@ -45,18 +59,10 @@ script_logger = logger.bind(script_run_datetime=script_run_datetime)
 
 
 
-# Comment out line 50 when loading cloud db
-db = ''
-db = db + 'LOCAL_'
-
-# Set variables
-DB_NAME = os.environ[f'{db}DB_NAME']
-DB_USER = os.environ[f'{db}DB_USER']
-DB_HOST = os.environ[f'{db}DB_HOST']
-DB_PASSWORD = os.environ[f'{db}DB_PASSWORD']
+# Set variables (database settings are in db.py)
 NOAA_TOKEN = os.environ['NOAA_TOKEN']
 header = {'token': NOAA_TOKEN}
-base_url = "https://www.ncdc.noaa.gov/cdo-web/api/v2/data?datasetid=GHCND"
+base_url = API_URL + "/data?datasetid=GHCND"
 datatype = "&datatypeid=TMIN,TMAX,PRCP,SNOW,SNWD"
 station_id_pre = "&stationid="
 start_date_pre = "&startdate="
@@ -65,25 +71,18 @@ units = "&units=standard"
 limit = "&limit=1000"
 offset_pre = "&offset="
 
+# CDO limits daily datasets to a one year date range per request
+MAX_WINDOW_DAYS = 365
+# windows are sized to fill pages to this fraction, leaves room for coverage being a little off
+PAGE_FILL = 0.95
+num_datatypes = len(datatype.split('=')[1].split(','))
+# keeps packed multi-station urls well under url length limits
+MAX_STATIONS_PER_REQUEST = 50
 
 
 
-def db_connect():
-    connection_string = f'dbname={DB_NAME} user={DB_USER} host={DB_HOST} password={DB_PASSWORD}'
-
-    try:
-        connection = psycopg2.connect(connection_string)
-        connection.autocommit = True
-        print('Database connection successful')
-    
-    except:
-        sys.exit('Unable to connect to the database')
-
-    cursor = connection.cursor(cursor_factory=DictCursor)
-    return cursor
-
-
 
+# only read to carry calls made by older versions over into the rate limiter's sqlite ledger
 def load_api_limit_list():
     if os.path.exists('api_calls.json'):
         
@@ -100,338 +99,1016 @@ def load_api_limit_list():
 
 
 
-def save_api_limit_list():
-    with open('api_calls.json', 'w') as file_out:
-        json.dump(DAILY_RATE_LIMIT, file_out)
+def exit_script(flush=True):
+    # fetch/writer threads only unwind here, the main thread cleans up once the pool has stopped
+    if threading.current_thread() is not threading.main_thread():
+        sys.exit()
     
+    if flush:
+        flush_data()
+    
+    report_metrics()
+    RATE_LIMITER.close()
+    db.close_pool()
+    sys.exit()
+
+
+
+def report_metrics():
+    # periodic summary line plus the Prometheus textfile, also called once on exit
+    METRICS.gauge('quota_remaining', RATE_LIMITER.remaining())
+    print(METRICS.summary())
+
+    if metrics_file:
+        METRICS.write_textfile(metrics_file)
+
     return
 
 
 
-def load_data(results):
+UPSERT_SQL = """INSERT INTO weather.weather_usa_97 (station_id, date, datatype, value, attributes) VALUES ($1,$2,$3,$4,$5)
+    ON CONFLICT (station_id, date, datatype) DO UPDATE SET value = EXCLUDED.value, attributes = EXCLUDED.attributes"""
+
+STAGE_SQL = """CREATE TEMP TABLE IF NOT EXISTS weather_stage
+    (LIKE weather.weather_usa_97 INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"""
+
+COPY_SQL = "COPY weather_stage (station_id, date, datatype, value, attributes) FROM STDIN"
+
+# DISTINCT ON keeps a duplicated key within the batch from hitting the same row twice
+MERGE_SQL = """INSERT INTO weather.weather_usa_97 (station_id, date, datatype, value, attributes)
+    SELECT DISTINCT ON (station_id, date, datatype) station_id, date, datatype, value, attributes FROM weather_stage
+    ORDER BY station_id, date, datatype
+    ON CONFLICT (station_id, date, datatype) DO UPDATE SET value = EXCLUDED.value, attributes = EXCLUDED.attributes"""
+
+
+
+def load_data(rows, checkpoint):
+    # one transaction per page: prepared per-row upserts plus the page checkpoint
+    started = time.perf_counter()
+
+    try:
+        with db.transaction() as cursor:
+            if storage_mode == 'compact':
+                compact_storage.load_compact(cursor, rows, wide_rows)
+            else:
+                db.execute_prepared(cursor, 'upsert_weather', UPSERT_SQL, rows)
+            if maintain_rollups:
+                rollups.update_rollups(cursor, rollups.station_months(rows), storage_mode)
+            save_checkpoints(cursor, [checkpoint])
+            record_loaded_windows(cursor, [checkpoint])
+        
+        if storage_mode == 'compact':
+            compact_storage.commit_partitions({int(row[1][:4]) for row in rows})
+        if maintain_rollups and rows:
+            rollups.mark_ready()
+    
+    except:
+        script_logger.error('Unable to load database', station=rows[0][0] if rows else None)
+        exit_script(flush=False)
+    
+    METRICS.observe('write_seconds', time.perf_counter() - started)
+    METRICS.count('rows_written', len(rows))
+    return
+
+
+
+def load_data_bulk(rows, checkpoints=(), windows=()):
+    # stage the batch with COPY and merge it into the fact table with one set-based upsert
+    # page checkpoints are written in the same transaction so progress never runs ahead of the data
+    # windows are (station_id, start, end) ledger rows for loads that do not come from api pages (ghcnd_archive.py)
+    started = time.perf_counter()
+    buffer = db.copy_buffer(rows)
+    years = {int(row[1][:4]) for row in rows}
+
+    try:
+        with db.transaction() as cursor:
+            if rows and storage_mode == 'compact':
+                compact_storage.copy_compact(cursor, buffer, years, wide_rows)
             
-    for result in results:
-        try:
-            insert_sql = "INSERT INTO weather.weather_usa_97 (station_id, date, datatype, value, attributes) VALUES (%s,%s,%s,%s,%s) ON CONFLICT (station_id, date, datatype) DO UPDATE SET value = %s, attributes = %s"
-            cursor.execute(insert_sql, (result['station'], result['date'], result['datatype'], result['value'], result['attributes'], result['value'], result['attributes']))
+            elif rows:
+                cursor.execute(STAGE_SQL)
+                cursor.copy_expert(COPY_SQL, buffer)
+                db.execute_prepared(cursor, 'merge_weather', MERGE_SQL)
+            
+            if maintain_rollups:
+                rollups.update_rollups(cursor, rollups.station_months(rows), storage_mode)
+            
+            save_checkpoints(cursor, list(checkpoints))
+            record_loaded_windows(cursor, list(checkpoints))
+            db.execute_prepared(cursor, 'record_window', LEDGER_SQL, list(windows))
         
-        except:
-            save_api_limit_list()
-            cursor.close()
-            script_logger.error('Unable to load database', station=result['station'])
-            sys.exit()
+        if storage_mode == 'compact':
+            compact_storage.commit_partitions(years)
+        if maintain_rollups and rows:
+            rollups.mark_ready()
+    
+    except:
+        script_logger.error('Unable to bulk load database', station=rows[0][0] if rows else None, rows=len(rows))
+        exit_script(flush=False)
+    
+    METRICS.observe('write_seconds', time.perf_counter() - started)
+    METRICS.count('rows_written', len(rows))
+    return
+
+
+
+def roll_up_regions():
+    # load batches only keep the station rollups current, region rows are recomputed once at the end of a run
+    if maintain_rollups:
+        rollups.update_region_rollups()
+    return
+
+
+
+def buffer_data(rows, checkpoint):
+    # load_mode 'row' keeps the original per-row upsert as a fallback, checkpoint saved right after the page
+    if load_mode == 'row':
+        load_data(rows, checkpoint)
+        return
+    
+    ROW_BUFFER.extend(rows)
+    
+    # only the latest page of each request needs to be kept
+    PENDING_CHECKPOINTS[checkpoint[0]] = checkpoint
+    
+    if len(ROW_BUFFER) >= batch_size:
+        flush_data()
+    
+    return
+
+
+
+def flush_data():
+    global ROW_BUFFER
+
+    if ROW_BUFFER or PENDING_CHECKPOINTS:
+        load_data_bulk(ROW_BUFFER, PENDING_CHECKPOINTS.values())
+        ROW_BUFFER = []
+        PENDING_CHECKPOINTS.clear()
     
     return
 
 
 
 def rate_limit_check(url):
-    global SECONDS_RATE_LIMIT
-    global DAILY_RATE_LIMIT
+    # per second and daily budgets are both enforced by the shared token bucket
+    started = time.perf_counter()
 
+    try:
+        RATE_LIMITER.acquire()
+    
+    except DailyLimitExceeded as hours:
+        print(f'10,000 calls per day limit reached in {hours} hours')
+        script_logger.error('Daily API Limit Exceeded', url=url)
+        exit_script()
     
-    # SECONDS RATE LIMIT CHECK
-    # check max of 5 api calls per second
-    now = time.time()
+    METRICS.observe('rate_limit_wait_seconds', time.perf_counter() - started)
+    return
+
+
+
+# api result dict -> (station_id, date, datatype, value, attributes), itemgetter runs the whole page in C
+ROW_GETTER = operator.itemgetter('station', 'date', 'datatype', 'value', 'attributes')
+
 
-    if len(SECONDS_RATE_LIMIT) < 4:
-        SECONDS_RATE_LIMIT.append(now)
+
+def page_rows(results):
+    # the page's dicts are dropped as soon as iterate_pages swaps in these rows
+    return list(map(ROW_GETTER, results))
+
+
+
+def get_data(url_pre, offset=1):
+    # another fetch thread hit a fatal error, stop making calls
+    if STOP_EVENT.is_set():
+        return
     
-    else:
-        time_diff = now - SECONDS_RATE_LIMIT[0]
+    pages = 0
+    for page_offset, status_code, json_results in iterate_pages(url_pre, header, offset, retries, rate_limit_check,
+                                                                cache=RESPONSE_CACHE, row_factory=page_rows, observe=METRICS.observe):
+        url = url_pre + str(page_offset)
+
+        if json_results is not None:
+            results = json_results.get('results')
+            pages += 1
+            METRICS.count('pages')
+            METRICS.count('rows_fetched', len(results or []))
+            
+            if results is None:
+                script_logger.warning('No results', url=url)
+                page = ([], (url_pre, page_offset, 0, True))
+            else:
+                page = (results, page_checkpoint(url_pre, page_offset, json_results))
+
+            if PAGE_QUEUE is not None:
+                PAGE_QUEUE.put(page)
+            else:
+                buffer_data(*page)
+
+        elif status_code is None:
+            script_logger.error('Request failed', url=url)
+            record_failure(url_pre, page_offset, status_code)
         
-        if time_diff < 1.1:
-            sleep_time = 1.1 - time_diff
-            time.sleep(sleep_time)
-            SECONDS_RATE_LIMIT.append(now + sleep_time)
+        # API is a bit glitchy at times, iterate_pages already re-requested with backoff
+        elif status_code in (200, 429) or 500 <= status_code < 600:
+            script_logger.error('Exceeded retries', status_code=status_code, url=url)
+            record_failure(url_pre, page_offset, status_code)
         
         else:
-            SECONDS_RATE_LIMIT.append(now)
+            script_logger.error(f'Unknown error: {status_code}', status_code=status_code, url=url)
+            record_failure(url_pre, page_offset, status_code)
+            exit_script()
         
-        SECONDS_RATE_LIMIT = SECONDS_RATE_LIMIT[1:]
+        if STOP_EVENT.is_set():
+            break
     
+    METRICS.observe('pages_per_request', pages, PAGE_BUCKETS)
+    return
     
-    # DAILY RATE LIMIT CHECK
-    # check max of 10,000 api calls per day
-    now = time.time()
 
-    if len(DAILY_RATE_LIMIT) < 9999:
-        DAILY_RATE_LIMIT.append(now)
+
+def year_windows(mindate, maxdate):
+    # original calendar year windows, used when a station's coverage is unknown
+    start_yr, end_yr = mindate[:4], maxdate[:4]
+    num_years = int(end_yr) - int(start_yr) +1
+    windows = []
+
+
+    for year in range(num_years):
+
+        if num_years == 1:
+            windows.append((mindate, maxdate))
+
+        elif year == 0:
+            windows.append((mindate, start_yr + "-12-31"))
+
+        elif year == num_years - 1:
+            windows.append((end_yr + "-01-01", maxdate))
+
+        else:
+            windows.append((str(int(start_yr) + year) + "-01-01", str(int(start_yr) + year) + "-12-31"))
     
-    else:
-        time_diff = now - DAILY_RATE_LIMIT[0]
+    return windows
+
+
 
-        if time_diff < 86460.0:
-            print(f'10,000 calls per day limit reached in {round(time_diff/3600, 2)} hours')
+def rows_per_day(coverage):
+    coverage = 1.0 if coverage is None else float(coverage)
+    return max(num_datatypes * coverage, 0.01)
 
-            save_api_limit_list()
-            cursor.close()
-            script_logger.error('Daily API Limit Exceeded', url=url)
-            sys.exit()
+
+
+def window_days(coverage):
+    # window length (days) with the fewest expected calls per day of history
+    # either k full pages worth of days, or the max range when that is reached first
+    best_days, best_rate = MAX_WINDOW_DAYS, None
+    pages = 1
+
+    while True:
+        days = min(MAX_WINDOW_DAYS, int(pages * PAGE_SIZE * PAGE_FILL / rows_per_day(coverage)))
         
-        else:
-            DAILY_RATE_LIMIT.append(now)
+        if days >= 1:
+            rate = expected_calls(days, coverage) / days
+
+            if best_rate is None or rate < best_rate or (rate == best_rate and days > best_days):
+                best_days, best_rate = days, rate
         
-        DAILY_RATE_LIMIT = DAILY_RATE_LIMIT[1:]
-    
-    return
+        if days == MAX_WINDOW_DAYS:
+            break
         
+        pages += 1
+    
+    return best_days
+
+
 
+def expected_calls(days, coverage):
+    return max(1, math.ceil(days * rows_per_day(coverage) / (PAGE_SIZE * PAGE_FILL)))
 
-def get_data(url_pre, offset=1, attempts=1):
-    url = url_pre + str(offset)
+
+
+def plan_windows(mindate, maxdate, coverage=None):
+    # date windows sized from data_coverage and the number of datatypes so pages come back full
+    if coverage is None:
+        return year_windows(mindate, maxdate)
     
-    rate_limit_check(url)
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        status_code = response.status_code
+    step = timedelta(days=window_days(coverage))
+    start, end = date.fromisoformat(mindate), date.fromisoformat(maxdate)
+    windows = []
+
+    while start <= end:
+        window_end = min(start + step - timedelta(days=1), end)
+        windows.append((str(start), str(window_end)))
+        start = window_end + timedelta(days=1)
     
+    return windows
+
+
+
+def window_url(station_id, start, end):
+    return base_url + datatype + station_id_pre + station_id + start_date_pre + start + end_date_pre + end + units + limit + offset_pre
+
+
+
+def window_urls(station_id, mindate, maxdate, coverage=None):
+    return [window_url(station_id, start, end) for start, end in plan_windows(mindate, maxdate, coverage)]
+
+
+
+def pending_windows(station_id, mindate, maxdate, coverage=None):
+    # (url_pre, offset, planned calls) for every window not yet completed, resuming at the last committed page
+    windows = []
+
+    for start, end in plan_windows(mindate, maxdate, coverage):
+        url_pre = window_url(station_id, start, end)
+        next_offset, completed = CHECKPOINTS.get(url_pre, (1, False))
+
+        if not completed:
+            days = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+            calls = max(1, expected_calls(days, coverage) - (next_offset - 1) // PAGE_SIZE)
+            windows.append((url_pre, next_offset, calls))
+    
+    return windows
+
+
+
+def api_call_generator(windows):
+    for done, (url_pre, offset, calls) in enumerate(windows):
+        METRICS.gauge('requests_remaining', len(windows) - done)
+        get_data(url_pre, offset)
+    
+    METRICS.gauge('requests_remaining', 0)
+    return
+
+
+
+# load ledger: one row per completed window, what is left to load is the gaps between them
+LEDGER_TABLE_SQL = """CREATE TABLE IF NOT EXISTS weather.load_ledger (
+    station_id text NOT NULL,
+    start_date date NOT NULL,
+    end_date date NOT NULL,
+    loaded_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (station_id, start_date, end_date))"""
+
+LEDGER_SQL = "INSERT INTO weather.load_ledger (station_id, start_date, end_date) VALUES ($1,$2,$3) ON CONFLICT DO NOTHING"
+
+# fact table of each storage_mode
+FACT_TABLES = {'compact': 'weather.observations', 'legacy': 'weather.weather_usa_97'}
+
+# stations loaded before the ledger existed: seeded once, when the ledger is created, from the active fact table
+# a seeded range stops the day before the station's last loaded date, the rest of that day's page may never have been
+# committed, so that day is loaded again with the gap after it
+# two index probes per catalog station on the (station_id, date, datatype) key instead of a DISTINCT over the whole table
+SEED_LEDGER_SQL = """INSERT INTO weather.load_ledger (station_id, start_date, end_date)
+    SELECT c.station_id, lo.date::date, hi.date::date - 1 FROM weather.weather_stations c
+    CROSS JOIN LATERAL (SELECT w.date FROM {table} w WHERE w.station_id = c.station_id ORDER BY w.date LIMIT 1) lo
+    CROSS JOIN LATERAL (SELECT w.date FROM {table} w WHERE w.station_id = c.station_id ORDER BY w.date DESC LIMIT 1) hi
+    WHERE hi.date::date > lo.date::date
+    ON CONFLICT DO NOTHING"""
+
+
+
+# failure ledger: one row per request that gave up, resumed at the failed page by populate_weather(rerun_fails=True)
+# rows are deleted in the transaction that completes the request
+FAILURE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS weather.load_failures (
+    url_pre text PRIMARY KEY,
+    station_ids text[] NOT NULL,
+    start_date date NOT NULL,
+    end_date date NOT NULL,
+    page_offset integer NOT NULL,
+    status_code integer,
+    attempts integer NOT NULL DEFAULT 1,
+    failed_at timestamp NOT NULL DEFAULT now())"""
+
+FAILURE_SQL = """INSERT INTO weather.load_failures (url_pre, station_ids, start_date, end_date, page_offset, status_code)
+    VALUES ($1,$2,$3,$4,$5,$6) ON CONFLICT (url_pre) DO UPDATE SET page_offset = EXCLUDED.page_offset,
+    status_code = EXCLUDED.status_code, attempts = weather.load_failures.attempts + 1, failed_at = now()"""
+
+
+
+def create_ledger(cursor):
+    # the seed only runs in the transaction that creates the ledger
+    # after that a station without ledger rows was never fully loaded, partial windows resume at their page checkpoint
+    cursor.execute("SELECT to_regclass('weather.load_ledger') IS NULL, to_regclass(%s) IS NOT NULL", (FACT_TABLES[storage_mode],))
+    new_ledger, has_facts = cursor.fetchone()
+    cursor.execute(LEDGER_TABLE_SQL)
+
+    if new_ledger and has_facts:
+        cursor.execute(SEED_LEDGER_SQL.format(table=FACT_TABLES[storage_mode]))
+        print(f'Load ledger seeded for {cursor.rowcount} previously loaded stations')
+
+    return
+
+
+
+def create_load_tables(cursor):
+    # page progress, load ledger and failure ledger, written by every load path
+    create_progress_table(cursor)
+    create_ledger(cursor)
+    cursor.execute(FAILURE_TABLE_SQL)
+    return
+
+
+
+def windows_of(url_pre):
+    # [(station_id, startdate, enddate)] for every station in a data request
+    params = parse_qs(urlparse(url_pre).query)
+    return [(station_id, params['startdate'][0], params['enddate'][0]) for station_id in params['stationid']]
+
+
+
+def record_loaded_windows(cursor, checkpoints):
+    rows = [window for checkpoint in checkpoints if checkpoint[3] for window in windows_of(checkpoint[0])]
+    db.execute_prepared(cursor, 'record_window', LEDGER_SQL, rows)
+
+    completed = [checkpoint[0] for checkpoint in checkpoints if checkpoint[3]]
+    if completed:
+        db.execute_prepared(cursor, 'clear_failures', "DELETE FROM weather.load_failures WHERE url_pre = ANY($1)", [(completed,)])
+    return
+
+
+
+def record_failure(url_pre, offset, status_code):
+    # called where get_data gives up on a page, from any fetch thread
+    METRICS.count('failures')
+    windows = windows_of(url_pre)
+    row = (url_pre, [window[0] for window in windows], windows[0][1], windows[0][2], offset, status_code)
+
+    try:
+        with db.transaction() as cursor:
+            db.execute_prepared(cursor, 'record_failure', FAILURE_SQL, [row])
+
     except:
-        script_logger.error('Request failed', url=url)
-        return
+        script_logger.error('Unable to record failure', url=url_pre + str(offset))
+
+    return
+
+
+
+# pages before the failed one may have been lost from ROW_BUFFER when the run died (copy mode),
+# so a retry starts at the failed page or the last committed page, whichever comes first
+FAILED_WINDOWS_SQL = """SELECT f.url_pre, LEAST(f.page_offset, coalesce(p.next_offset, 1)) FROM weather.load_failures f
+    LEFT JOIN weather.load_progress p ON p.request_key = f.url_pre ORDER BY f.failed_at"""
+
+
+
+def failed_windows(cursor):
+    # (url_pre, offset, calls) for every request still in the failure ledger, oldest first
+    create_load_tables(cursor)
+    cursor.execute(FAILED_WINDOWS_SQL)
+    return [(url_pre, offset, 1) for url_pre, offset in cursor.fetchall()]
+
+
+
+def ledger_gaps(start, end, loaded):
+    # parts of [start, end] not covered by the loaded (start, end) ranges, sorted by start
+    gaps = []
+    one_day = timedelta(days=1)
+
+    for loaded_start, loaded_end in loaded:
+        if loaded_end < start:
+            continue
+        if loaded_start > end:
+            break
+        if loaded_start > start:
+            gaps.append((start, loaded_start - one_day))
+        start = max(start, loaded_end + one_day)
+    
+    if start <= end:
+        gaps.append((start, end))
     
+    return gaps
 
-    if status_code == 200:
-        # Need to reset attempts here for next API call
-        attempts = 1
 
-        json_results = response.json()
 
-        try:
-            results = json_results['results']
-        
-        except KeyError:
-            script_logger.warning('No results', url=url)
-            return
-        
-        load_data(results)
+def create_partitions(cursor, mindate, maxdate):
+    # compact storage: every year between mindate and maxdate gets its partitions before loading starts
+    # so concurrent loaders (fetch threads, backfill_coordinator.py workers) do not create them mid-batch
+    if storage_mode != 'compact':
+        return []
+
+    years = range(mindate.year, maxdate.year + 1)
+    compact_storage.ensure_partitions(cursor, years, wide_rows)
+    return years
+
+
+
+def plan_gaps(cursor, filtered_stations, mindate, maxdate):
+    # [(station_id, coverage, [(gap_start, gap_end), ...])] for every station with something left to load
+    station_ids = [station_result[0] for station_result in filtered_stations]
+
+    create_load_tables(cursor)
+    cursor.execute("""SELECT station_id, start_date, end_date FROM weather.load_ledger
+                   WHERE station_id = ANY(%s) ORDER BY station_id, start_date""", (station_ids,))
+    
+    loaded = {}
+    for station_id, start_date, end_date in cursor.fetchall():
+        loaded.setdefault(station_id, []).append((start_date, end_date))
+    
+    plan = []
+    for station_result in filtered_stations:
+        station_id = station_result[0]
+        coverage = station_result[5] if len(station_result) > 5 else None
+        gaps = ledger_gaps(max(station_result[3], mindate), min(station_result[4], maxdate), loaded.get(station_id, []))
+
+        if gaps:
+            plan.append((station_id, coverage, gaps))
+    
+    return plan
+
+
+
+def multi_station_url(station_ids, start, end):
+    # the data endpoint takes repeated stationid params, results carry their own station field
+    return base_url + datatype + ''.join(station_id_pre + station_id for station_id in station_ids) + start_date_pre + start + end_date_pre + end + units + limit + offset_pre
+
+
 
-        offset += 1000
-        if (offset <=  json_results['metadata']['resultset']['count']):
-            get_data(url_pre, offset, attempts)
+def is_sparse(coverage):
+    # a full max-range window of this station still fits in one page, so it can share requests
+    return MAX_WINDOW_DAYS * rows_per_day(coverage) <= PAGE_SIZE * PAGE_FILL
+
+
+
+def pack_windows(station_windows):
+    # [(station_id, start, end, coverage)] -> [(url_pre, offset, planned calls)]
+    # stations with the same date window are packed into multi-station requests that fill about one page
+    # results are split back per station by their station field (load) and windows_of (ledger)
+    groups = {}
+    for station_id, start, end, coverage in station_windows:
+        groups.setdefault((start, end), []).append((station_id, coverage))
+
+    windows = []
+    for (start, end), stations in groups.items():
+        days = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+        batches, batch, batch_rows = [], [], 0
+
+        for station_id, coverage in stations:
+            station_rows = days * rows_per_day(coverage)
+
+            if batch and (batch_rows + station_rows > PAGE_SIZE * PAGE_FILL or len(batch) == MAX_STATIONS_PER_REQUEST):
+                batches.append((batch, batch_rows))
+                batch, batch_rows = [], 0
             
-    # API is a bit glitchy at times, usually just need to re-request
-    elif status_code >= 500 and status_code < 600:
+            batch.append(station_id)
+            batch_rows += station_rows
+        
+        batches.append((batch, batch_rows))
+
+        for batch, batch_rows in batches:
+            url_pre = multi_station_url(batch, start, end)
+            next_offset, completed = CHECKPOINTS.get(url_pre, (1, False))
+
+            if not completed:
+                windows.append((url_pre, next_offset, max(1, math.ceil(batch_rows / (PAGE_SIZE * PAGE_FILL)) - (next_offset - 1) // PAGE_SIZE)))
+    
+    return windows
+
 
-        if attempts < retries:
-            attempts += 1
-            get_data(url_pre, offset, attempts)
+
+def refresh_windows(cursor, filtered_stations, maxdate, overlap_days):
+    # tail window from each station's last loaded date up to maxdate, not the catalog max_date which
+    # is only as recent as the last populate_stations run
+    # the last overlap_days are re-requested since recent observations are often reported late
+    station_ids = [station_result[0] for station_result in filtered_stations]
+
+    create_load_tables(cursor)
+    cursor.execute("""SELECT station_id, max(end_date) FROM weather.load_ledger
+                   WHERE station_id = ANY(%s) GROUP BY station_id""", (station_ids,))
+    last_loaded = dict(cursor.fetchall())
+
+    tails = []
+    skipped = 0
+    for station_result in filtered_stations:
+        station_id = station_result[0]
+        coverage = station_result[5] if len(station_result) > 5 else None
+
+        if station_id not in last_loaded:
+            skipped += 1
+            continue
+
+        start = max(last_loaded[station_id] - timedelta(days=overlap_days), station_result[3])
+
+        # never loaded or too far behind for one request, left to a backfill run
+        if (maxdate - start).days >= MAX_WINDOW_DAYS:
+            skipped += 1
+            continue
         
-        else:
-            script_logger.error('Exceeded retries', status_code=status_code, url=url)
+        if start <= maxdate:
+            tails.append((station_id, start, coverage))
     
+    if skipped:
+        print(f'{skipped} stations need a backfill run before they can be refreshed')
+
+    # tails starting within overlap_days of each other share one window from the earliest start, so stations
+    # last loaded a day or two apart are still packed into the same requests (the extra days are upserted again)
+    windows = []
+    group_start = None
+    for station_id, start, coverage in sorted(tails, key=operator.itemgetter(1)):
+        if group_start is None or (start - group_start).days > overlap_days:
+            group_start = start
+
+        windows.append((station_id, str(group_start), str(maxdate), coverage))
+
+    return pack_windows(windows)
+
+
+
+def refresh_weather(filtered_stations, maxdate, overlap_days=7, workers=1):
+    # incremental mode: only the tail of every already loaded station, up to maxdate
+    global CHECKPOINTS
+
+    with db.transaction() as cursor:
+        create_progress_table(cursor)
+        CHECKPOINTS = load_checkpoints(cursor)
+        years = create_partitions(cursor, maxdate - timedelta(days=MAX_WINDOW_DAYS + overlap_days), maxdate)
+        windows = refresh_windows(cursor, filtered_stations, maxdate, overlap_days)
+
+    compact_storage.commit_partitions(years)
+
+    planned_calls = sum(calls for url_pre, offset, calls in windows)
+    print(f'Refresh requests: {len(windows)}')
+    print(f'Planned API calls: {planned_calls} ({RATE_LIMITER.remaining()} left today)')
+
+    if workers > 1:
+        fetch_concurrent(windows, workers)
     else:
-        save_api_limit_list()
-        cursor.close()
-        script_logger.error(f'Unknown error: {status_code}', status_code=status_code, url=url)
-        sys.exit()
+        api_call_generator(windows)
     
     return
+
+
+
+def db_writer(page_queue, write_failed):
+    # single consumer that does all the loading, keeps draining after a failure so fetch threads never block
+    while True:
+        page = page_queue.get()
+
+        if page is None:
+            break
+
+        if STOP_EVENT.is_set():
+            continue
+
+        try:
+            buffer_data(*page)
+        
+        except SystemExit:
+            write_failed.set()
+            STOP_EVENT.set()
     
+    return
 
 
-def api_call_generator(station_id, mindate, maxdate):
-    start_yr, end_yr = mindate[:4], maxdate[:4]
-    num_years = int(end_yr) - int(start_yr) +1
 
+def fetch_concurrent(windows, workers):
+    # keeps up to `workers` requests in flight across stations and years while db_writer loads pages
+    global PAGE_QUEUE
 
-    for year in range(num_years):
+    PAGE_QUEUE = queue.Queue(maxsize=workers * 4)
+    write_failed = threading.Event()
+    writer = threading.Thread(target=db_writer, args=(PAGE_QUEUE, write_failed), daemon=True)
+    writer.start()
 
-        if num_years == 1:
-            url_pre = base_url + datatype + station_id_pre + station_id + start_date_pre + mindate + end_date_pre + maxdate + units + limit + offset_pre
-            get_data(url_pre)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_data, url_pre, offset) for url_pre, offset, calls in windows]
 
-        elif year == 0:
-            url_pre = base_url + datatype + station_id_pre + station_id + start_date_pre + mindate + end_date_pre + start_yr + "-12-31" + units + limit + offset_pre
-            get_data(url_pre)
+        for remaining, future in enumerate(as_completed(futures)):
+            METRICS.gauge('requests_remaining', len(futures) - remaining - 1)
 
-        elif year == num_years - 1:
-            url_pre = base_url + datatype + station_id_pre + station_id + start_date_pre + end_yr + "-01-01" + end_date_pre + maxdate + units + limit + offset_pre
-            get_data(url_pre)
+            try:
+                future.result()
+            
+            except SystemExit:
+                STOP_EVENT.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                break
+    
+    PAGE_QUEUE.put(None)
+    writer.join()
+    PAGE_QUEUE = None
 
-        else:
-            url_pre = base_url + datatype + station_id_pre + station_id + start_date_pre + str(int(start_yr) + year) + "-01-01" + end_date_pre + str(int(start_yr) + year) + "-12-31" + units + limit + offset_pre
-            get_data(url_pre)
+    if STOP_EVENT.is_set():
+        exit_script(flush=not write_failed.is_set())
     
     return
 
 
 
 # clustering algorithm
+# returns the cluster label of every station, aligned to the rows of df
 def cluster_stations(df, radius):
-    coords = df[['latitude', 'longitude']].to_numpy()
+    coords = df[['latitude', 'longitude']].to_numpy(dtype=float)
     kms_per_radian = 6371.0088
     epsilon = radius / kms_per_radian
-    db = DBSCAN(eps=epsilon, min_samples=1, algorithm='ball_tree', metric='haversine').fit(np.radians(coords))
-    cluster_labels = db.labels_
-    num_clusters = len(set(cluster_labels))
-    clusters = pd.Series([coords[cluster_labels == n] for n in range(num_clusters)])
-    return clusters
+    dbscan = DBSCAN(eps=epsilon, min_samples=1, algorithm='ball_tree', metric='haversine', n_jobs=-1).fit(np.radians(coords))
+    return pd.Series(dbscan.labels_, index=df.index)
 
 
 
-# choose point in cluster with highest coverage
-def get_highest_coverage_station(clusters, stations):
-    points = pd.DataFrame()
-    for cluster in clusters:
-        lats, lons = zip(*cluster)
-        cluster_df = pd.DataFrame({'lat':lats, 'lon':lons})
-        cluster_df = cluster_df.apply(lambda row: stations[(stations['latitude']==row['lat']) & (stations['longitude']==row['lon'])].iloc[0], axis=1)
-        chosen = cluster_df[cluster_df.datacoverage == cluster_df.datacoverage.max()]
-        points = pd.concat([points, chosen.head(1)], ignore_index=True, sort=False)
-    return points
+# choose point in cluster with highest coverage (first station on ties)
+def get_highest_coverage_station(labels, stations):
+    chosen = stations['data_coverage'].astype(float).groupby(labels).idxmax()
+    return stations.loc[chosen.sort_values()]
 
 
-def create_global_map(station_results, outfile):
-    f = folium.Figure()
-    m = folium.Map(location=(30, 10)\
-                , zoom_start=3\
-                , min_zoom=3\
-                , tiles="cartodb positron"\
-                , max_bounds=True).add_to(f)
-    
-    for row in station_results:
-        folium.CircleMarker([row[1], row[2]], radius=1, color='purple', fill=True, fill_color='purple').add_to(m)
-    
-    if not os.path.exists('weather_maps'):
-        os.system('mkdir weather_maps')
-    
-    m.save(f'weather_maps/{outfile}.html')
-    print(f'Map saved at: weather_maps/{outfile}.html')
 
+# radius ladder in km, resolution n runs the first n + 1 passes
+radii = [5, 25, 50, 75, 100, 150, 200, 300, 400, 500]
+
+# survivors of every pass of the ladder {resolution: station ids}
+# each pass clusters the survivors of the previous one, so later (wider) passes work on far fewer stations
+def station_hierarchy(stations):
+    levels = {}
+    for resolution, radius in enumerate(radii):
+        labels = cluster_stations(stations, radius)
+        stations = get_highest_coverage_station(labels, stations)
+        levels[resolution] = stations['station_id'].to_list()
+    return levels
+
+
+
+# the hierarchy is stored once per candidate station set and rebuilt only when that set's
+# ids, coordinates or coverage change (fingerprint below)
+HIERARCHY_TABLE_SQL = """CREATE TABLE IF NOT EXISTS weather.station_hierarchy (
+    resolution smallint NOT NULL,
+    station_id text NOT NULL,
+    PRIMARY KEY (resolution, station_id));
+    CREATE TABLE IF NOT EXISTS weather.station_hierarchy_meta (
+    fingerprint text NOT NULL,
+    built_at timestamp NOT NULL DEFAULT now())"""
+
+def refresh_station_hierarchy(cursor, stations_query):
+    cursor.execute(HIERARCHY_TABLE_SQL)
+    cursor.execute(f"""SELECT md5(string_agg(concat_ws(':', station_id, latitude, longitude, data_coverage), ',' ORDER BY station_id))
+                   FROM ({stations_query}) s""")
+    fingerprint = cursor.fetchone()[0]
+
+    cursor.execute("SELECT fingerprint FROM weather.station_hierarchy_meta")
+    stored = cursor.fetchone()
+    if stored is not None and stored[0] == fingerprint:
+        return
+
+    print('Station coverage changed, rebuilding station hierarchy')
+    cursor.execute(stations_query)
+    df = pd.DataFrame(cursor.fetchall(), columns=['station_id', 'latitude', 'longitude', 'min_date', 'max_date', 'data_coverage'])
+    levels = station_hierarchy(df) if len(df) else {}
+
+    cursor.execute("DELETE FROM weather.station_hierarchy")
+    cursor.execute("DELETE FROM weather.station_hierarchy_meta")
+    execute_values(cursor, "INSERT INTO weather.station_hierarchy (resolution, station_id) VALUES %s",\
+                   [(resolution, station_id) for resolution, station_ids in levels.items() for station_id in station_ids], page_size=10000)
+    cursor.execute("INSERT INTO weather.station_hierarchy_meta (fingerprint) VALUES (%s)", (fingerprint,))
     return
 
 
+# map rendering picks a layer by point count so the html stays small as station counts grow
+# up to MAP_MARKER_LIMIT: one CircleMarker per station
+# up to MAP_CLUSTER_LIMIT: a single FastMarkerCluster layer, points are one js array drawn on canvas
+# above that: stations binned into a MAP_GRID_DEGREES grid rendered as one density image
+MAP_MARKER_LIMIT = 2000
+MAP_CLUSTER_LIMIT = 200000
+MAP_GRID_DEGREES = 0.25
+MERCATOR_MAX_LAT = 85.0
 
-def create_usa_map(station_results, outfile):
+CIRCLE_CALLBACK = """function (row) {
+    return L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 1, color: 'purple', fill: true, fillColor: 'purple'});
+}"""
+
+
+
+def density_image(coords):
+    # log-scaled station count per grid cell as an rgba array, empty cells are transparent
+    lat_bins = np.arange(-MERCATOR_MAX_LAT, MERCATOR_MAX_LAT + MAP_GRID_DEGREES, MAP_GRID_DEGREES)
+    lon_bins = np.arange(-180, 180 + MAP_GRID_DEGREES, MAP_GRID_DEGREES)
+    counts, _, _ = np.histogram2d(coords[:, 0], coords[:, 1], bins=[lat_bins, lon_bins])
+
+    scaled = np.log1p(counts)
+    scaled = scaled / scaled.max() if scaled.max() > 0 else scaled
+    image = colormaps['Purples'](0.3 + 0.7 * scaled)
+    image[..., 3] = np.where(counts > 0, 0.85, 0)
+
+    # histogram rows run south to north, the image origin is the top row
+    return image[::-1]
+
+
+
+def create_map(station_results, outfile, location, zoom_start):
     f = folium.Figure()
-    m = folium.Map(location=(40, -98.5)\
-                , zoom_start=4\
+    m = folium.Map(location=location\
+                , zoom_start=zoom_start\
                 , min_zoom=3\
                 , tiles="cartodb positron"\
                 , max_bounds=True).add_to(f)
     
-    for row in station_results:
-        folium.CircleMarker([row[1], row[2]], radius=1, color='purple', fill=True, fill_color='purple').add_to(m)
+    coords = np.array([(row[1], row[2]) for row in station_results], dtype=float).reshape(-1, 2)
+
+    if len(coords) <= MAP_MARKER_LIMIT:
+        for lat, lon in coords:
+            folium.CircleMarker([lat, lon], radius=1, color='purple', fill=True, fill_color='purple').add_to(m)
+    
+    elif len(coords) <= MAP_CLUSTER_LIMIT:
+        FastMarkerCluster(coords.round(4).tolist(), callback=CIRCLE_CALLBACK).add_to(m)
     
-    if not os.path.exists('weather_maps'):
-        os.system('mkdir weather_maps')
+    else:
+        folium.raster_layers.ImageOverlay(density_image(coords)\
+                                        , bounds=[[-MERCATOR_MAX_LAT, -180], [MERCATOR_MAX_LAT, 180]]\
+                                        , mercator_project=True).add_to(m)
+    
+    os.makedirs('weather_maps', exist_ok=True)
     
     m.save(f'weather_maps/{outfile}.html')
-    print(f'Map saved at: weather_maps/{outfile}.html')
+    print(f'Map saved at: weather_maps/{outfile}.html ({len(coords)} stations)')
 
     return
 
 
 
-def get_log_rerun_stations():
-    try:
-        with open('populate_weather_log.json', 'r') as file:
-            log_entries = [json.loads(line) for line in file]
-            
-        log_df = pd.json_normalize(log_entries).rename(columns={'context.url':'url',\
-                                                                'context.status_code':'status_code',\
-                                                                'context.attempts':'attempts',\
-                                                                'context.key_error':'key_error',\
-                                                                'context.station':'station',\
-                                                                'context.script_run_datetime':'script_run_datetime'})
-        log_df.drop_duplicates(inplace=True)
-
-        if 'station' in log_df.columns:
-            log_df['station'].fillna(log_df['url'].str[108:125])
+def create_global_map(station_results, outfile):
+    create_map(station_results, outfile, location=(30, 10), zoom_start=3)
+    return
+
+
+
+def create_usa_map(station_results, outfile):
+    create_map(station_results, outfile, location=(40, -98.5), zoom_start=4)
+    return
+
+
+
+def plan_backfill(filtered_stations, mindate, maxdate, single_station_load=False):
+    # (dense station plan, shared windows) still to load between mindate and maxdate
+    # dense: [(station_id, gaps, windows)], shared: packed multi-station windows for sparse stations
+    global CHECKPOINTS
+
+    # page checkpoints from earlier runs, a restarted run resumes at the exact page
+    with db.transaction() as cursor:
+        create_progress_table(cursor)
+        CHECKPOINTS = load_checkpoints(cursor)
+        years = create_partitions(cursor, mindate, maxdate)
+        gaps = plan_gaps(cursor, filtered_stations, mindate, maxdate)
+
+    compact_storage.commit_partitions(years)
+
+    if single_station_load:
+        gaps = gaps[:1]
+
+    # dense stations get their own coverage-sized windows, sparse stations share calendar-year
+    # windows so stations with the same year can be packed into one request
+    plan = []
+    shared = []
+
+    for station_id, coverage, station_gaps in gaps:
+        if is_sparse(coverage):
+            shared += [(station_id, start, end, coverage) for gap_start, gap_end in station_gaps for start, end in year_windows(str(gap_start), str(gap_end))]
         else:
-            log_df['station'] = log_df['url'].str[108:125]
-        
-        return log_df.loc[log_df.level == 'ERROR', 'station'].unique().to_list()
+            windows = [window for gap_start, gap_end in station_gaps for window in pending_windows(station_id, str(gap_start), str(gap_end), coverage)]
+            plan.append((station_id, station_gaps, windows))
     
-    except:
-        return []
+    shared_windows = pack_windows(shared)
+    
+    # planned call count up front so the daily quota can be budgeted
+    planned_calls = sum(calls for station in plan for url_pre, offset, calls in station[2]) + sum(calls for url_pre, offset, calls in shared_windows)
+    print(f'Number of stations to load: {len(gaps)} ({len(gaps) - len(plan)} sparse stations in {len(shared_windows)} shared requests)')
+    print(f'Planned API calls: {planned_calls} ({round(planned_calls / 10000, 2)} days of quota, {RATE_LIMITER.remaining()} left today)')
+
+    return plan, shared_windows
 
 
 
-def populate_weather(filtered_stations, mindate, maxdate, single_station_load=True, rerun_fails=False): 
+def populate_weather(filtered_stations, mindate, maxdate, single_station_load=True, rerun_fails=False, workers=1): 
+    # rerun_fails only retries the requests in the failure ledger, each from the page that failed
     if rerun_fails:
-        reruns = get_log_rerun_stations()
+        with db.transaction() as cursor:
+            windows = failed_windows(cursor)
+
+        print(f'Failed requests to retry: {len(windows)}')
+
+        if workers > 1:
+            fetch_concurrent(windows, workers)
+        else:
+            api_call_generator(windows)
         
-    else:
-        reruns = []
+        return
 
-    query = "SELECT DISTINCT station_id FROM weather.weather_usa_97"
-    cursor.execute(query)
-    stations_loaded = cursor.fetchall()
+    plan, shared_windows = plan_backfill(filtered_stations, mindate, maxdate, single_station_load)
 
-    stations_loaded = [result[0] for result in stations_loaded]
-    print(f'Number of stations to load: {len(filtered_stations) - len(stations_loaded) + len(reruns)}')
+    if workers > 1:
+        fetch_concurrent([window for station in plan for window in station[2]] + shared_windows, workers)
+        return
 
-    for station_result in filtered_stations:
-        station_id = station_result[0]
-        
-        if station_id in stations_loaded and station_id not in reruns:
-            continue
-        
-        mindate = max(station_result[3], mindate)
-        maxdate = min(station_result[4], maxdate)
+    for station_id, station_gaps, windows in plan:
         print(f'\nRetrieving data for station: {station_id}')
-        print(f'mindate: {mindate}, maxdate: {maxdate}')
+        for gap_start, gap_end in station_gaps:
+            print(f'mindate: {gap_start}, maxdate: {gap_end}')
 
-        api_call_generator(station_id, str(mindate), str(maxdate))
-        
-        if single_station_load:
-            break
+        api_call_generator(windows)
+    
+    if shared_windows:
+        print(f'\nRetrieving shared requests for sparse stations')
+        api_call_generator(shared_windows)
     
     return
 
 
 
-def filter_stations(create_station_html=True):
+def filter_stations(create_station_html=True, resolution=None):
     query = """
-            SELECT station_id, latitude, longitude, min_date, max_date FROM weather.weather_stations
+            SELECT station_id, latitude, longitude, min_date, max_date, data_coverage FROM weather.weather_stations
             WHERE country_code = 'US'
             AND max_date >= ('2025-05-13')::date
             AND min_date <= ('1950-01-01')::date
             AND data_coverage >= 0.97"""
     # CURRENT_DATE - INTERVAL '30 days'
     
-    cursor.execute(query)
-    station_results = cursor.fetchall()
+    with db.transaction() as cursor:
+        if resolution is None:
+            cursor.execute(query)
+        
+        # use clustering hierarchy and keep the station with highest coverage at this resolution
+        else:
+            refresh_station_hierarchy(cursor, query)
+            cursor.execute(f"""SELECT s.* FROM ({query}) s JOIN weather.station_hierarchy h USING (station_id)
+                           WHERE h.resolution = %s ORDER BY s.station_id""", (resolution,))
+        
+        station_results = cursor.fetchall()
 
     if create_station_html:
         # create_global_map(station_results, 'weather_stations_usa_97')
         create_usa_map(station_results, 'weather_stations_usa_97')
+    
+    return station_results
 
 
-    # # use clustering algorithm and choose station with highest coverage
-    # radii = [5, 25, 50, 75, 100, 150, 200, 300, 400, 500]
-    # radii = radii[:resolution + 1]
 
-    # for radius in radii:
-    #     clusters = cluster_stations(df, radius)
-    #     df = get_highest_coverage_station(clusters, df)
-    
-    # filtered_stations = df['id'].to_list()
-    # station_results = [x for x in station_results if x[0] in filtered_stations]
+
+def set_variables(token=NOAA_TOKEN, rate_limiter=None, response_cache=None):
+    # loader state, also called by backfill_coordinator.py worker processes with their own token
+    # benchmark.py passes its own rate_limiter and response_cache so nothing is read from or written to the working directory
+    global header, METRICS, metrics_file, RATE_LIMITER, RESPONSE_CACHE, STOP_EVENT, PAGE_QUEUE, retries, load_mode, batch_size, ROW_BUFFER, PENDING_CHECKPOINTS, CHECKPOINTS, storage_mode, wide_rows, maintain_rollups
+
+    header = {'token': token}
+
+    # timings, counters and quota for report_metrics(), metrics_file is read by node_exporter's textfile collector
+    METRICS = Metrics()
+    metrics_file = 'populate_weather.prom'
+
+    # shared token bucket for the per second and daily limits, persisted in api_calls.sqlite after every call
+    # and shared by every loader process using the same token
+    RATE_LIMITER = rate_limiter
+    if RATE_LIMITER is None:
+        RATE_LIMITER = TokenBucket(token)
+        if token == NOAA_TOKEN:
+            RATE_LIMITER.import_calls(load_api_limit_list())
+
+    # pages already downloaded are served from disk, replays cost no api calls
+    RESPONSE_CACHE = response_cache if response_cache is not None else ResponseCache('noaa_cache')
+
+    STOP_EVENT = threading.Event()
+    PAGE_QUEUE = None
     
-    return station_results
+    # RETRIES is number of api calls when there is a 503 error before skipping
+    retries = 4
+
+    # load_mode 'copy' stages rows with COPY and upserts batch_size rows per transaction
+    # load_mode 'row' is the original one upsert per observation (fallback)
+    load_mode = 'copy'
+    batch_size = 10000
+    ROW_BUFFER = []
+    PENDING_CHECKPOINTS = {}
+    CHECKPOINTS = {}
+
+    # storage_mode 'legacy' is the original weather.weather_usa_97 table
+    # storage_mode 'compact' writes weather.observations (yearly partitions, smallint datatype, parsed flags),
+    # switch once compact_storage.py has migrated weather_usa_97, the load ledger treats its stations as loaded
+    # wide_rows also pivots TMIN/TMAX/PRCP/SNOW/SNWD into one weather.daily_core row per station-day
+    storage_mode = 'legacy'
+    wide_rows = True
+
+    # maintain_rollups recomputes the monthly/annual station summaries touched by every batch
+    # and the region summaries above them once the run is done
+    maintain_rollups = True
+
+    return
 
 
 
 
 if __name__ == "__main__":
     # Connect to database
-    cursor = db_connect()
+    db.get_pool()
 
     
     '''
     set variables
     '''
-    # creates empty list for seconds
-    SECONDS_RATE_LIMIT = []
-    
-    # creates either an empty list for daily or load in existing from api_calls.json
-    DAILY_RATE_LIMIT = load_api_limit_list()
-    
-    # RETRIES is number of api calls when there is a 503 error before skipping
-    retries = 4
+    set_variables()
+
+    # seconds between metrics summaries
+    report_interval = 60
+
+    # number of requests kept in flight, 1 is the original one page at a time loop
+    workers = 4
 
     # resolution is 0 - 9 and refers to the index in this list
     # [5, 25, 50, 75, 100, 150, 200, 300, 400, 500]
@@ -439,14 +1116,29 @@ if __name__ == "__main__":
     # this is only used when reducing stations geographically with clustering algorithm in filter_stations()
     resolution = 5
 
+    # refresh True only requests each loaded station's tail up to today (nightly run)
+    # refresh False is the full backfill from min_date
+    refresh = False
+
+    # rerun_fails True only retries the requests recorded in weather.load_failures
+    rerun_fails = False
+
     min_date = datetime.strptime('1950-01-01', '%Y-%m-%d').date()
     max_date = date.today()
 
     
     filtered_stations = filter_stations(create_station_html=False)
+    reporting = start_reporting(report_metrics, report_interval)
 
-    populate_weather(filtered_stations, min_date, max_date, single_station_load=False)
-
-    save_api_limit_list()
-    cursor.close()
+    if refresh:
+        refresh_weather(filtered_stations, max_date, workers=workers)
+    else:
+        populate_weather(filtered_stations, min_date, max_date, single_station_load=False, rerun_fails=rerun_fails, workers=workers)
+
+    flush_data()
+    roll_up_regions()
+    reporting.set()
+    report_metrics()
+    RATE_LIMITER.close()
+    db.close_pool()
 
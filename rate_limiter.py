@@ -0,0 +1,118 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+
+# NOAA CDO limits: 5 calls per second and 10,000 calls per day per token
+# defaults stay a little under both, same margins the scripts have always used
+SECONDS_RATE = 4 / 1.1
+SECONDS_BURST = 4
+DAILY_LIMIT = 9999
+DAILY_WINDOW = 86460.0
+
+LEDGER_FILE = 'api_calls.sqlite'
+
+
+
+
+class DailyLimitExceeded(Exception):
+    pass
+
+
+
+
+class TokenBucket:
+    # rate limiter state lives in a small sqlite file, updated in one transaction per call
+    # so a crash never loses the daily count and every process using the same token shares it
+    # per second: token bucket (GCRA form), `next_at` is when the bucket is next empty
+    # per day: call counts per minute for the last `daily_window` seconds
+
+    def __init__(self, token, path=LEDGER_FILE, rate=SECONDS_RATE, burst=SECONDS_BURST, daily_limit=DAILY_LIMIT, daily_window=DAILY_WINDOW):
+        self.key = hashlib.sha256(token.encode()).hexdigest()[:16]
+        self.rate = rate
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.daily_window = daily_window
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, next_at REAL NOT NULL)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS calls (key TEXT NOT NULL, minute INTEGER NOT NULL,
+                                count INTEGER NOT NULL, PRIMARY KEY (key, minute))''')
+
+
+    def import_calls(self, timestamps):
+        # one-time import of the old api_calls.json timestamp list, skipped once the ledger has calls
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                if self.connection.execute('SELECT 1 FROM calls WHERE key = ? LIMIT 1', (self.key,)).fetchone() is None:
+                    for timestamp in timestamps:
+                        self.record(int(timestamp // 60))
+
+                self.connection.execute('COMMIT')
+
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return
+
+
+    def record(self, minute):
+        self.connection.execute('''INSERT INTO calls (key, minute, count) VALUES (?, ?, 1)
+                                ON CONFLICT (key, minute) DO UPDATE SET count = count + 1''', (self.key, minute))
+        return
+
+
+    def acquire(self):
+        # reserves a call slot and sleeps (outside the lock) until it is due
+        # raises DailyLimitExceeded with the hours the current window took to fill
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                now = time.time()
+                first_minute = int((now - self.daily_window) // 60) + 1
+                self.connection.execute('DELETE FROM calls WHERE key = ? AND minute < ?', (self.key, first_minute))
+                used, oldest = self.connection.execute('SELECT coalesce(sum(count), 0), min(minute) FROM calls WHERE key = ?', (self.key,)).fetchone()
+
+                if used >= self.daily_limit:
+                    raise DailyLimitExceeded(round((now - oldest * 60) / 3600, 2))
+
+                row = self.connection.execute('SELECT next_at FROM bucket WHERE key = ?', (self.key,)).fetchone()
+                interval = 1 / self.rate
+                next_at = max(row[0] if row else now, now)
+                wait = max(0.0, next_at - now - (self.burst - 1) * interval)
+
+                self.connection.execute('INSERT OR REPLACE INTO bucket (key, next_at) VALUES (?, ?)', (self.key, next_at + interval))
+                self.record(int((now + wait) // 60))
+                self.connection.execute('COMMIT')
+
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+
+    def remaining(self):
+        with self.lock:
+            first_minute = int((time.time() - self.daily_window) // 60) + 1
+            used = self.connection.execute('SELECT coalesce(sum(count), 0) FROM calls WHERE key = ? AND minute >= ?', (self.key, first_minute)).fetchone()[0]
+
+        return self.daily_limit - used
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+        return
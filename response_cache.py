@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlparse, parse_qs
+import orjson
+
+
+
+# windows ending this many days ago or earlier are treated as immutable history
+RECENT_DAYS = 30
+# recent windows and the station catalog are only reused for this long
+RECENT_TTL = 86400.0
+MAX_BYTES = 2 * 1024 ** 3
+
+
+
+
+class ResponseCache:
+    # on-disk cache of NOAA pages: one gzipped file per full request url (sha256 of the url)
+    # holding a json line with the url and fetch time, then the response body exactly as the api sent it
+    # file mtime is the last access time, least recently used files are evicted past max_bytes
+
+    def __init__(self, directory='noaa_cache', max_bytes=MAX_BYTES, recent_days=RECENT_DAYS, recent_ttl=RECENT_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.recent_days = recent_days
+        self.recent_ttl = recent_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.json.gz'))
+
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.json.gz')
+
+
+    def ttl(self, url):
+        # None means the response never expires
+        end_date = parse_qs(urlparse(url).query).get('enddate')
+
+        if end_date and date.fromisoformat(end_date[0][:10]) < date.today() - timedelta(days=self.recent_days):
+            return None
+
+        return self.recent_ttl
+
+
+    def get(self, url):
+        # raw response body, or None
+        path = self.path(url)
+
+        try:
+            with gzip.open(path, 'rb') as file_in:
+                entry = orjson.loads(file_in.readline())
+                body = file_in.read()
+
+        except (OSError, EOFError, orjson.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        ttl = self.ttl(url)
+        # entries written before bodies were cached raw have no body after the first line
+        if not body or entry.get('url') != url or (ttl is not None and time.time() - entry['fetched'] > ttl):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.hits += 1
+
+        return body
+
+
+    def put(self, url, body):
+        # body is the response content as bytes
+        path = self.path(url)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+
+        with gzip.open(tmp_path, 'wb') as file_out:
+            file_out.write(orjson.dumps({'url': url, 'fetched': time.time()}) + b'\n')
+            file_out.write(body)
+
+        size = os.path.getsize(tmp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size += size - old_size
+            over = self.size > self.max_bytes
+
+        if over:
+            self.evict()
+
+        return
+
+
+    def evict(self):
+        # drop least recently used files until the cache is back under 90% of max_bytes
+        with self.lock:
+            entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith('.json.gz')), key=lambda entry: entry.stat().st_mtime)
+            self.size = sum(entry.stat().st_size for entry in entries)
+
+            for entry in entries:
+                if self.size <= self.max_bytes * 0.9:
+                    break
+
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self.size -= size
+
+                except OSError:
+                    pass
+
+        return
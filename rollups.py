@@ -0,0 +1,238 @@
+from datetime import date
+import db
+import compact_storage
+
+
+
+# monthly and annual climate summaries per station and per region, kept current by populate_weather.py
+# every load batch, in either storage mode, recomputes only the station-months it touched and the station years above them,
+# and queues those station-months in weather.rollup_pending
+# region rows are shared by every loader, so update_region_rollups() recomputes them from the queue once per run
+# values are in the api's standard units (F, inches), means are over days with an observation
+
+# set once the tables are known to exist in this process
+READY = False
+
+
+
+
+ROLLUP_TABLES_SQL = """CREATE TABLE IF NOT EXISTS weather.station_monthly (
+    station_id text NOT NULL,
+    year smallint NOT NULL,
+    month smallint NOT NULL,
+    tmin_mean real,
+    tmax_mean real,
+    prcp_total real,
+    snow_days smallint NOT NULL,
+    obs_days smallint NOT NULL,
+    tmin_days smallint NOT NULL,
+    tmax_days smallint NOT NULL,
+    prcp_days smallint NOT NULL,
+    days_in_month smallint NOT NULL,
+    PRIMARY KEY (station_id, year, month));
+
+    CREATE TABLE IF NOT EXISTS weather.station_annual (
+    station_id text NOT NULL,
+    year smallint NOT NULL,
+    tmin_mean real,
+    tmax_mean real,
+    prcp_total real,
+    snow_days smallint NOT NULL,
+    obs_days smallint NOT NULL,
+    months_reported smallint NOT NULL,
+    PRIMARY KEY (station_id, year));
+
+    CREATE TABLE IF NOT EXISTS weather.region_monthly (
+    region text NOT NULL,
+    year smallint NOT NULL,
+    month smallint NOT NULL,
+    stations integer NOT NULL,
+    tmin_mean real,
+    tmax_mean real,
+    prcp_mean real,
+    snow_days_mean real,
+    completeness real,
+    PRIMARY KEY (region, year, month));
+
+    CREATE TABLE IF NOT EXISTS weather.region_annual (
+    region text NOT NULL,
+    year smallint NOT NULL,
+    stations integer NOT NULL,
+    tmin_mean real,
+    tmax_mean real,
+    prcp_mean real,
+    snow_days_mean real,
+    PRIMARY KEY (region, year));
+
+    CREATE TABLE IF NOT EXISTS weather.rollup_pending (
+    station_id text NOT NULL,
+    month_start date NOT NULL,
+    PRIMARY KEY (station_id, month_start))"""
+
+# touched (station_id, first day of month) pairs come in as two arrays, observations is the storage mode's OBSERVATIONS_SQL
+STATION_MONTHLY_SQL = """INSERT INTO weather.station_monthly AS m
+    SELECT k.station_id, extract(year FROM k.month_start), extract(month FROM k.month_start),
+    avg(o.value) FILTER (WHERE o.datatype = 'TMIN'), avg(o.value) FILTER (WHERE o.datatype = 'TMAX'),
+    sum(o.value) FILTER (WHERE o.datatype = 'PRCP'), count(*) FILTER (WHERE o.datatype = 'SNOW' AND o.value > 0),
+    count(DISTINCT o.date), count(*) FILTER (WHERE o.datatype = 'TMIN'), count(*) FILTER (WHERE o.datatype = 'TMAX'),
+    count(*) FILTER (WHERE o.datatype = 'PRCP'),
+    extract(day FROM k.month_start + interval '1 month' - interval '1 day')
+    FROM unnest(%s::text[], %s::date[]) AS k(station_id, month_start)
+    JOIN ({observations}) o ON o.station_id = k.station_id AND o.date >= k.month_start AND o.date < k.month_start + interval '1 month'
+    GROUP BY k.station_id, k.month_start
+    ON CONFLICT (station_id, year, month) DO UPDATE SET tmin_mean = EXCLUDED.tmin_mean, tmax_mean = EXCLUDED.tmax_mean,
+    prcp_total = EXCLUDED.prcp_total, snow_days = EXCLUDED.snow_days, obs_days = EXCLUDED.obs_days, tmin_days = EXCLUDED.tmin_days,
+    tmax_days = EXCLUDED.tmax_days, prcp_days = EXCLUDED.prcp_days, days_in_month = EXCLUDED.days_in_month"""
+
+# annual means are weighted by the days behind each monthly mean
+STATION_ANNUAL_SQL = """INSERT INTO weather.station_annual AS a
+    SELECT m.station_id, m.year,
+    sum(m.tmin_mean * m.tmin_days) / nullif(sum(m.tmin_days), 0), sum(m.tmax_mean * m.tmax_days) / nullif(sum(m.tmax_days), 0),
+    sum(m.prcp_total), sum(m.snow_days), sum(m.obs_days), count(*)
+    FROM weather.station_monthly m
+    JOIN (SELECT DISTINCT station_id, extract(year FROM month_start)::smallint AS year
+          FROM unnest(%s::text[], %s::date[]) AS k(station_id, month_start)) k USING (station_id, year)
+    GROUP BY m.station_id, m.year
+    ON CONFLICT (station_id, year) DO UPDATE SET tmin_mean = EXCLUDED.tmin_mean, tmax_mean = EXCLUDED.tmax_mean,
+    prcp_total = EXCLUDED.prcp_total, snow_days = EXCLUDED.snow_days, obs_days = EXCLUDED.obs_days, months_reported = EXCLUDED.months_reported"""
+
+# loaders touching the same station take turns until commit, in station order so two batches never wait on each other,
+# a recompute that waited starts from a snapshot that already has the other loader's rows
+STATION_LOCK_SQL = """SELECT pg_advisory_xact_lock(hashtext(station_id)) FROM unnest(%s::text[]) AS station_id
+    ORDER BY station_id"""
+
+# keyed by station, so concurrent loaders queue their months without waiting on each other
+PENDING_SQL = """INSERT INTO weather.rollup_pending (station_id, month_start)
+    SELECT * FROM unnest(%s::text[], %s::date[]) ON CONFLICT DO NOTHING"""
+
+# region values are means over the region's stations, completeness is observed days over station-days
+REGION_MONTHLY_SQL = """INSERT INTO weather.region_monthly AS r
+    SELECT coalesce(s.region, 'unknown'), m.year, m.month, count(*),
+    avg(m.tmin_mean), avg(m.tmax_mean), avg(m.prcp_total), avg(m.snow_days), sum(m.obs_days)::real / sum(m.days_in_month)
+    FROM weather.station_monthly m JOIN weather.weather_stations s USING (station_id)
+    JOIN (SELECT DISTINCT coalesce(s.region, 'unknown') AS region, extract(year FROM k.month_start)::smallint AS year,
+          extract(month FROM k.month_start)::smallint AS month
+          FROM unnest(%s::text[], %s::date[]) AS k(station_id, month_start) JOIN weather.weather_stations s USING (station_id)) k
+    ON k.region = coalesce(s.region, 'unknown') AND k.year = m.year AND k.month = m.month
+    GROUP BY 1, m.year, m.month
+    ON CONFLICT (region, year, month) DO UPDATE SET stations = EXCLUDED.stations, tmin_mean = EXCLUDED.tmin_mean,
+    tmax_mean = EXCLUDED.tmax_mean, prcp_mean = EXCLUDED.prcp_mean, snow_days_mean = EXCLUDED.snow_days_mean,
+    completeness = EXCLUDED.completeness"""
+
+REGION_ANNUAL_SQL = """INSERT INTO weather.region_annual AS r
+    SELECT coalesce(s.region, 'unknown'), a.year, count(*), avg(a.tmin_mean), avg(a.tmax_mean), avg(a.prcp_total), avg(a.snow_days)
+    FROM weather.station_annual a JOIN weather.weather_stations s USING (station_id)
+    JOIN (SELECT DISTINCT coalesce(s.region, 'unknown') AS region, extract(year FROM k.month_start)::smallint AS year
+          FROM unnest(%s::text[], %s::date[]) AS k(station_id, month_start) JOIN weather.weather_stations s USING (station_id)) k
+    ON k.region = coalesce(s.region, 'unknown') AND k.year = a.year
+    GROUP BY 1, a.year
+    ON CONFLICT (region, year) DO UPDATE SET stations = EXCLUDED.stations, tmin_mean = EXCLUDED.tmin_mean,
+    tmax_mean = EXCLUDED.tmax_mean, prcp_mean = EXCLUDED.prcp_mean, snow_days_mean = EXCLUDED.snow_days_mean"""
+
+
+
+
+def create_rollup_tables(cursor):
+    cursor.execute(ROLLUP_TABLES_SQL)
+    return
+
+
+
+def station_months(rows):
+    # sorted (station_id, first day of month) pairs touched by (station_id, date, ...) rows
+    return sorted({(row[0], str(row[1])[:7] + '-01') for row in rows})
+
+
+
+def month_keys(months):
+    # (station_id, month_start) pairs as the two arrays the rollup statements take
+    return ([station_id for station_id, month_start in months], [month_start for station_id, month_start in months])
+
+
+
+def update_rollups(cursor, months, storage_mode='legacy'):
+    # months from station_months(), recomputed from the storage mode's fact table in the loading transaction
+    if not months:
+        return
+
+    if not READY:
+        create_rollup_tables(cursor)
+
+    keys = month_keys(months)
+
+    cursor.execute(STATION_LOCK_SQL, (sorted(set(keys[0])),))
+    cursor.execute(STATION_MONTHLY_SQL.format(observations=compact_storage.OBSERVATIONS_SQL[storage_mode]), keys)
+    cursor.execute(STATION_ANNUAL_SQL, keys)
+    cursor.execute(PENDING_SQL, keys)
+
+    return
+
+
+
+def update_region_rollups():
+    # recomputes the region months and years of every queued station-month, months queued meanwhile wait for the next pass
+    with db.transaction() as cursor:
+        create_rollup_tables(cursor)
+        cursor.execute("DELETE FROM weather.rollup_pending RETURNING station_id, month_start::text")
+        months = cursor.fetchall()
+
+        if months:
+            keys = month_keys(months)
+            cursor.execute(REGION_MONTHLY_SQL, keys)
+            cursor.execute(REGION_ANNUAL_SQL, keys)
+
+    print(f'Region rollups updated for {len(months)} station-months')
+    return
+
+
+
+def mark_ready():
+    # called once a transaction that created the tables committed
+    global READY
+    READY = True
+    return
+
+
+
+def rebuild_rollups(first_year, last_year, storage_mode='legacy'):
+    # full rebuild for data loaded before rollups existed, one transaction per year
+    for year in range(first_year, last_year + 1):
+        with db.transaction() as cursor:
+            create_rollup_tables(cursor)
+            cursor.execute(f"""SELECT DISTINCT station_id, date_trunc('month', date)::date::text FROM ({compact_storage.OBSERVATIONS_SQL[storage_mode]}) o
+                           WHERE date >= %s AND date < %s""", (f'{year}-01-01', f'{year + 1}-01-01'))
+            months = sorted(cursor.fetchall())
+            update_rollups(cursor, months, storage_mode)
+
+        update_region_rollups()
+        print(f'Rolled up {year}: {len(months)} station-months')
+
+    mark_ready()
+    return
+
+
+
+
+if __name__ == "__main__":
+    # Connect to database
+    db.get_pool()
+
+
+    '''
+    set variables
+    '''
+    # rebuild True recomputes everything between first_year and last_year (data loaded before rollups existed)
+    # rebuild False only recomputes the region rows queued by loads that did not finish their run
+    rebuild = False
+    first_year = 1950
+    last_year = date.today().year
+    # same as populate_weather.py
+    storage_mode = 'legacy'
+
+
+    if rebuild:
+        rebuild_rollups(first_year, last_year, storage_mode)
+    else:
+        update_region_rollups()
+
+    db.close_pool()
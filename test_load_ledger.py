@@ -0,0 +1,103 @@
+import os
+import unittest
+from datetime import date, timedelta
+
+
+
+# load ledger planning: python -m unittest test_load_ledger
+# the database tests drop and recreate the weather schema of TEST_DB_NAME, they are skipped when it is not set
+os.environ['DB_TARGET'] = 'local'
+os.environ['LOCAL_DB_NAME'] = os.environ.get('TEST_DB_NAME', 'unused')
+for name in ('LOCAL_DB_USER', 'LOCAL_DB_HOST', 'LOCAL_DB_PASSWORD', 'NOAA_TOKEN'):
+    os.environ.setdefault(name, 'unused')
+
+import db
+import populate_weather
+from benchmark import BASE_TABLES_SQL
+
+START = date(2020, 1, 1)
+END = date(2020, 12, 31)
+
+
+
+
+def station(station_id):
+    # filter_stations row: station_id, latitude, longitude, min_date, max_date, data_coverage
+    return (station_id, 40.0, -100.0, START, END, 1)
+
+
+
+def insert_days(cursor, station_id, first, last):
+    # one TMAX row per day, what a window cut short after a few committed pages leaves behind
+    days = [(station_id, first + timedelta(days=day)) for day in range((last - first).days + 1)]
+    cursor.executemany("INSERT INTO weather.weather_usa_97 VALUES (%s, %s, 'TMAX', 50, ',,7,0700')", days)
+    return
+
+
+
+
+class LedgerGapsTest(unittest.TestCase):
+
+    def test_nothing_loaded(self):
+        self.assertEqual(populate_weather.ledger_gaps(START, END, []), [(START, END)])
+
+
+    def test_seeded_range_leaves_last_loaded_day(self):
+        # seeded up to the day before the last loaded date, that day is requested again with the rest
+        self.assertEqual(populate_weather.ledger_gaps(START, END, [(START, date(2020, 3, 9))]), [(date(2020, 3, 10), END)])
+
+
+    def test_gaps_between_windows(self):
+        loaded = [(date(2020, 2, 1), date(2020, 2, 29)), (date(2020, 6, 1), date(2020, 6, 30))]
+        self.assertEqual(populate_weather.ledger_gaps(START, END, loaded),
+                         [(START, date(2020, 1, 31)), (date(2020, 3, 1), date(2020, 5, 31)), (date(2020, 7, 1), END)])
+
+
+
+
+@unittest.skipUnless('TEST_DB_NAME' in os.environ, 'set TEST_DB_NAME to a throwaway database')
+class PlanGapsTest(unittest.TestCase):
+
+    def setUp(self):
+        populate_weather.storage_mode = 'legacy'
+        db.get_pool()
+        with db.transaction() as cursor:
+            cursor.execute(BASE_TABLES_SQL)
+            cursor.execute("INSERT INTO weather.weather_stations (station_id) VALUES ('A'), ('B')")
+
+
+    def tearDown(self):
+        db.close_pool()
+
+
+    def plan(self, *station_ids):
+        with db.transaction() as cursor:
+            return populate_weather.plan_gaps(cursor, [station(station_id) for station_id in station_ids], START, END)
+
+
+    def test_seed_stops_before_last_loaded_day(self):
+        # loaded before the ledger existed, the last day may be missing datatypes that were on the next page
+        with db.transaction() as cursor:
+            insert_days(cursor, 'A', START, date(2020, 3, 10))
+
+        self.assertEqual(self.plan('A'), [('A', 1, [(date(2020, 3, 10), END)])])
+
+
+    def test_partial_window_is_not_seeded(self):
+        # the ledger exists, a window cut short after some committed pages keeps its url and resumes at its checkpoint
+        self.assertEqual(self.plan('A', 'B'), [('A', 1, [(START, END)]), ('B', 1, [(START, END)])])
+
+        with db.transaction() as cursor:
+            insert_days(cursor, 'B', START, date(2020, 2, 15))
+
+        self.assertEqual(self.plan('A', 'B'), [('A', 1, [(START, END)]), ('B', 1, [(START, END)])])
+
+        with db.transaction() as cursor:
+            cursor.execute('SELECT count(*) FROM weather.load_ledger')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+
+
+if __name__ == "__main__":
+    unittest.main()